@@ -2,8 +2,12 @@
 
 import argparse
 import boto3
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sys
 import json
+import os
+import sqlite3
+import time
 from datetime import datetime
 from datetime import timezone
 import requests
@@ -11,54 +15,274 @@ import requests
 # Handle arguments
 parser = argparse.ArgumentParser(description='Send new AWS Health/PHD/Billing alerts to Slack')
 parser.add_argument('-r', '--aws-region', default='us-east-1')
-parser.add_argument('-p', '--profile-name')
+parser.add_argument('-p', '--profile-name', help="Profile to check, or a comma-separated list of them")
+parser.add_argument('-o', '--organization', action='store_true',
+                    help="Get events for the whole AWS Organization, using the (management or delegated admin) profile")
+parser.add_argument('-j', '--parallelism', type=int, default=8,
+                    help="How many accounts (or, with -o, events) to query at once (default 8)")
 parser.add_argument('-c', '--slack-channel')
+parser.add_argument('-e', '--event-regions', default='us-west-2',
+                    help="Comma-separated regions to post events for (default us-west-2)")
+parser.add_argument('-s', '--state-file',
+                    help="Where to keep track of events already posted (default /tmp/aws_health_state_<profile>.sqlite, "
+                         "or /tmp/aws_health_state.sqlite for several profiles)")
+parser.add_argument('--retention-days', type=int, default=90,
+                    help="Forget events that haven't been updated for this many days (default 90)")
 args = parser.parse_args()
 
-profile_name  = args.profile_name
+profile_names = (args.profile_name or '').split(',')
 region_name   = args.aws_region
 slack_channel = args.slack_channel
+event_regions = args.event_regions.split(',')
 
-state_file = '/tmp/aws_health_state_%s.json' % profile_name
+# All accounts share one state file
+if args.organization:
+    state_file = args.state_file or '/tmp/aws_health_state_org_%s.sqlite' % profile_names[0]
+elif len(profile_names) > 1:
+    state_file = args.state_file or '/tmp/aws_health_state.sqlite'
+else:
+    state_file = args.state_file or '/tmp/aws_health_state_%s.sqlite' % profile_names[0]
+# Where older versions kept each profile's state, as one big JSON list of events
+legacy_state_file = '/tmp/aws_health_state_%s.json'
 
-def post_to_slack(msg, channel_webhook = slack_channel):
-    try:
-        print("Posting to %s" % channel_webhook)
-        headers = { 'Content-type' : 'application/json', 'Accept' : 'text/plain' }
-        r = requests.post(channel_webhook, data=json.dumps({"text":msg,"icon_emoji":"ghost"}), headers=headers)
-    except Exception as e:
-        print(e)
+# Each run asks for events updated since the last one started, less this
+# much in case of clock skew; anything already posted is skipped anyway
+fetch_overlap = 3600
+
+class EventState(object):
+    # Event ARN -> the lastUpdatedTime we last posted it at.  It's kept in
+    # SQLite so lookups are indexed and each posted event is committed as it
+    # goes, instead of reloading and rewriting the whole history every run.
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS events (arn TEXT PRIMARY KEY, last_updated REAL NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY CHECK (id = 0), started REAL NOT NULL)")
+        self.db.commit()
+
+    def last_run(self):
+        row = self.db.execute("SELECT started FROM runs").fetchone()
+        return row[0] if row else None
+
+    def finish_run(self, started):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO runs (id, started) VALUES (0, ?)", (started,))
+
+    def last_updated(self, arn):
+        row = self.db.execute("SELECT last_updated FROM events WHERE arn = ?", (arn,)).fetchone()
+        return row[0] if row else None
+
+    def record(self, arn, last_updated):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO events (arn, last_updated) VALUES (?, ?)", (arn, last_updated))
+
+    def forget(self, arn):
+        with self.db:
+            self.db.execute("DELETE FROM events WHERE arn = ?", (arn,))
+
+    def expire(self, before):
+        with self.db:
+            return self.db.execute("DELETE FROM events WHERE last_updated < ?", (before,)).rowcount
+
+    def import_legacy(self, path):
+        # Carry over what a profile's old JSON state file had posted, so
+        # upgrading doesn't re-post every open event.  Renaming the file
+        # makes this once per file; what's already in the database is at
+        # least as recent, so it wins.
+        if not os.path.exists(path):
+            return
+        with open(path) as infile:
+            event_log = json.load(infile).get('event_log', [])
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO events (arn, last_updated) VALUES (?, ?)",
+                                [ (e['arn'], datetime.fromisoformat(e['lastUpdatedTime']).timestamp()) for e in event_log ])
+        os.rename(path, path + '.imported')
+        print("Imported %s events from %s" % (len(event_log), path))
+
+def get_events(health, regions, since=None):
+    # Let the Health API do the filtering, a page at a time.  Closed events
+    # are only asked for when we have a previous run, to forget about them.
+    event_filter = { 'regions': regions, 'eventStatusCodes': ['open', 'upcoming'] }
+    if since is not None:
+        event_filter['eventStatusCodes'].append('closed')
+        event_filter['lastUpdatedTimes'] = [ { 'from': datetime.fromtimestamp(since, timezone.utc) } ]
+    paginator = health.get_paginator('describe_events')
+    for page in paginator.paginate(filter=event_filter, PaginationConfig={ 'PageSize': 100 }):
+        for event in page['events']:
+            yield event
+
+def get_organization_events(health, regions, since=None):
+    # As get_events, for describe_events_for_organization, whose filter is
+    # shaped a little differently
+    event_filter = { 'regions': regions, 'eventStatusCodes': ['open', 'upcoming'] }
+    if since is not None:
+        event_filter['eventStatusCodes'].append('closed')
+        event_filter['lastUpdatedTime'] = { 'from': datetime.fromtimestamp(since, timezone.utc) }
+    paginator = health.get_paginator('describe_events_for_organization')
+    for page in paginator.paginate(filter=event_filter, PaginationConfig={ 'PageSize': 100 }):
+        for event in page['events']:
+            yield event
+
+def get_affected_accounts(health, event_arn):
+    paginator = health.get_paginator('describe_affected_accounts_for_organization')
+    return [ account for page in paginator.paginate(eventArn=event_arn) for account in page['affectedAccounts'] ]
+
+def health_client(profile):
+    # boto3 sessions aren't thread safe, so each thread makes its own
+    return boto3.Session(profile_name=profile or None).client('health', region_name=region_name)
+
+def get_profile_events(profile, since):
+    # (event, accounts affected) for one profile's account
+    return [ (event, [profile]) for event in get_events(health_client(profile), event_regions, since) ]
+
+def fetch_events(pool, since):
+    # Returns ([(event, accounts affected)], whether every account was
+    # fetched), querying accounts (or, with --organization, the affected
+    # accounts of each event) concurrently
+    if args.organization:
+        health = health_client(profile_names[0])
+        try:
+            events = list(get_organization_events(health, event_regions, since))
+        except Exception as e:
+            print("Couldn't get events for the organization: %s" % e)
+            return [], False
+        futures = dict((pool.submit(get_affected_accounts, health, event['arn']), event) for event in events)
+        results, complete = [], True
+        for future in as_completed(futures):
+            try:
+                affected = future.result()
+            except Exception as e:
+                print("Couldn't get the accounts affected by %s: %s" % (futures[future]['arn'], e))
+                complete = False
+                continue
+            # Public events don't list accounts; they're for everyone
+            results.append((futures[future], affected or [profile_names[0]]))
+        return results, complete
+    futures = dict((pool.submit(get_profile_events, profile, since), profile) for profile in profile_names)
+    results, complete = [], True
+    for future in as_completed(futures):
+        try:
+            results += future.result()
+        except Exception as e:
+            print("Couldn't get events for %s: %s" % (futures[future], e))
+            complete = False
+    return results, complete
+
+def merge_events(results):
+    # The same event (by ARN) can come from several accounts; keep its
+    # newest version and every account it was seen in
+    merged = {}
+    for event, accounts in results:
+        if event['arn'] in merged:
+            newest, seen_in = merged[event['arn']]
+            if newest['lastUpdatedTime'] >= event['lastUpdatedTime']:
+                event = newest
+            accounts = seen_in | set(accounts)
+        merged[event['arn']] = (event, set(accounts))
+    return sorted(merged.values(), key=lambda e: e[0]['lastUpdatedTime'])
+
+class SlackDelivery(object):
+    # Posts to a Slack webhook over one pooled keep-alive session.  A run's
+    # messages go out in as few posts as Slack allows (one block each, up to
+    # its block limits), 429s wait out Retry-After and other failures back
+    # off, all within max_retries.  post() is only True once Slack has
+    # answered 2xx, so nothing is marked posted that wasn't.
+    max_blocks = 50
+    max_block_text = 3000
+
+    def __init__(self, webhook, timeout=(5, 30), max_retries=5, max_wait=60):
+        self.webhook = webhook
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.headers.update({ 'Content-type' : 'application/json', 'Accept' : 'text/plain' })
+
+    def batches(self, messages):
+        for i in range(0, len(messages), self.max_blocks):
+            yield messages[i:i + self.max_blocks]
+
+    def retry_after(self, response, attempt):
+        try:
+            return min(self.max_wait, float(response.headers['Retry-After']))
+        except (KeyError, ValueError):
+            return min(self.max_wait, 2 ** attempt)
+
+    def post(self, messages):
+        if len(messages) == 1:
+            fallback = messages[0]
+        else:
+            fallback = "%s AWS Health events" % len(messages)
+        payload = { "text": fallback, "icon_emoji": "ghost",
+                    "blocks": [ { "type": "section", "text": { "type": "mrkdwn", "text": m[:self.max_block_text] } }
+                                for m in messages ] }
+        for attempt in range(self.max_retries + 1):
+            try:
+                print("Posting %s events to %s" % (len(messages), self.webhook))
+                r = self.session.post(self.webhook, data=json.dumps(payload), timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                reason, wait = e, min(self.max_wait, 2 ** attempt)
+            except requests.RequestException as e:
+                print(e)
+                return False
+            else:
+                if 200 <= r.status_code < 300:
+                    return True
+                if r.status_code != 429 and r.status_code < 500:
+                    print("Slack rejected the post: %s %s" % (r.status_code, r.text))
+                    return False
+                reason, wait = "%s %s" % (r.status_code, r.text), self.retry_after(r, attempt)
+            if attempt < self.max_retries:
+                print("Slack post failed (%s); retrying in %ss" % (reason, wait))
+                time.sleep(wait)
+        print("Giving up on posting %s events to Slack" % len(messages))
+        return False
 
 if __name__ == '__main__':
     # Get state file
-    try:
-        with open(state_file) as infile:
-            state = json.load(infile)
-    except:
-        state = { 'event_log': [] }
-
-    session = boto3.Session(profile_name=profile_name)
-    health  = session.client('health', region_name=region_name)
-    events  = health.describe_events()
-
-    for event in events['events']:
-        if event['region'] == 'us-west-2':
-            event['startTime']       = event['startTime'].isoformat()
-            event['endTime']         = event['endTime'].isoformat()
-            event['lastUpdatedTime'] = event['lastUpdatedTime'].isoformat()
-
-            # Ignore closed cases.  This is meant to run hourly or so, so it should catch ephemeral events well enough
-            if event['statusCode'] != "closed":
-                if event in state['event_log']:
-                    print("Object already exists in state file.")
-                else:
-                    pdb_url = "<https://phd.aws.amazon.com/phd/home?region=%s#/dashboard/scheduled-changes?eventID=%s&eventTab=affectedResources&layout=vertical|Personal Health Dashboard>" % (event['region'], event['arn'])
-                    msg = "Event: Account '%s', Type '%s', Status '%s', Code '%s'.  URL: %s" % (profile_name, event['eventTypeCategory'], event['statusCode'], event['eventTypeCode'], pdb_url)
-                    post_to_slack(msg, slack_channel)
-                    print("Adding object to state file.")
-                    state['event_log'].append(event)
-
-    # Re-press in state log file entries
-    with open(state_file, 'w') as outfile:
-        json.dump(state, outfile)
+    state = EventState(state_file)
+    for profile in profile_names:
+        state.import_legacy(legacy_state_file % profile)
+    started = time.time()
+    last_run = state.last_run()
+
+    with ThreadPoolExecutor(max_workers=args.parallelism) as pool:
+        results, complete = fetch_events(pool, last_run - fetch_overlap if last_run else None)
+
+    # (arn, lastUpdatedTime, message) to post
+    pending = []
+    for event, accounts in merge_events(results):
+        last_updated = event['lastUpdatedTime'].timestamp()
+
+        # Ignore closed cases.  This is meant to run hourly or so, so it should catch ephemeral events well enough
+        if event['statusCode'] == "closed":
+            state.forget(event['arn'])
+            continue
+
+        posted = state.last_updated(event['arn'])
+        if posted is not None and posted >= last_updated:
+            print("Event %s already posted." % event['arn'])
+            continue
+
+        pdb_url = "<https://phd.aws.amazon.com/phd/home?region=%s#/dashboard/scheduled-changes?eventID=%s&eventTab=affectedResources&layout=vertical|Personal Health Dashboard>" % (event['region'], event['arn'])
+        msg = "%s: Account '%s', Type '%s', Status '%s', Code '%s'.  URL: %s" % ("Updated event" if posted else "Event", ', '.join(sorted(accounts)), event['eventTypeCategory'], event['statusCode'], event['eventTypeCode'], pdb_url)
+        pending.append((event['arn'], last_updated, msg))
+
+    slack = SlackDelivery(slack_channel)
+    for batch in slack.batches(pending):
+        if not slack.post([ msg for arn, last_updated, msg in batch ]):
+            complete = False
+            continue
+        for arn, last_updated, msg in batch:
+            print("Adding event %s to state file." % arn)
+            state.record(arn, last_updated)
 
+    expired = state.expire(started - args.retention_days * 86400)
+    if expired:
+        print("Forgot %s events not updated in %s days." % (expired, args.retention_days))
+    # If an account couldn't be reached or Slack wouldn't take the events,
+    # look as far back next time
+    if complete:
+        state.finish_run(started)
+    else:
+        sys.exit(1)
@@ -7,30 +7,28 @@ import boto.ec2.cloudwatch
 import boto.ec2.elb
 import boto.elasticache
 import boto.rds
+import boto.sqs
+from boto.ec2.cloudwatch.alarm import MetricAlarm
+from boto.ec2.cloudwatch.dimension import Dimension
+from boto.ec2.cloudwatch.metric import Metric
+from boto.ec2.volume import Volume
+from boto.sqs.message import RawMessage
+from boto.compat import six
+from boto.exception import BotoServerError
+from multiprocessing.pool import ThreadPool
+import bisect
+import random
 import sys
+import threading
 import time
 import logging
+import copy
 import datetime
-
-# Handle arguments
-parser = argparse.ArgumentParser(description='Automatically create alerts')
-parser.add_argument('-p', '--profile-name', default='default')
-parser.add_argument('-r', '--aws-region', default='us-west-2')
-parser.add_argument('-s', '--sns-topic')
-parser.add_argument('-v', '--verbose', help="Set logging level to INFO", action="store_true")
-parser.add_argument('-vv', '--verbose-debug', help="Set logging level to DEBUG", action="store_true")
-args = parser.parse_args()
-
-profile_name = args.profile_name
-region       = args.aws_region
-sns_topic    = args.sns_topic
-
-if args.verbose:
-    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
-elif args.verbose_debug:
-    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
-else:
-    logging.basicConfig(stream=sys.stderr, level=logging.WARN)
+import json
+import os
+import re
+import sqlite3
+import multiprocessing
 
 def metric_human_readable(metric):
     # Support k/K/kb/KB = Kilobyte, m/M/mb/MB = Megabyte, g/G/gb/GB = Gigabyte, t/T/tb/TB = Terabyte
@@ -58,287 +56,2142 @@ def metric_human_readable(metric):
         # It's already in the format we want if it's all numbers; just convert to int
         return int(metric)
 
+# Alarm policy
+#
+# Which alarms get created, and their thresholds, live in a JSON (or YAML)
+# policy file; alarm_policy.json next to this script is the default.  The
+# policy is compiled once per run into a CompiledResourcePolicy per resource
+# type, with its name/tag patterns and threshold expressions already compiled,
+# so evaluating a resource is just a walk down its table of rules.
+
+default_policy_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alarm_policy.json')
+
+# The order resource types are processed in
+resource_type_order = ['ec2', 'ebs', 'elasticache', 'rds', 'elb']
+
+rule_keys = set(['name', 'metric', 'namespace', 'statistic', 'comparison', 'threshold',
+                 'period', 'evaluation_periods', 'when', 'group_by', 'aggregate', 'note', 'disabled'])
+resource_type_keys = set(['prefix', 'dimension_name', 'include_names', 'exclude_names',
+                          'include_tags', 'exclude_tags', 'composite_by', 'rules']) | rule_keys
+
+# Metric math functions a group_by rule can aggregate its members with
+math_aggregates = ['MAX', 'MIN', 'AVG', 'SUM']
+# boto's RDS and ElastiCache API versions predate tagging (and the ARNs it
+# needs), so their resources have no tags for the tag-based settings to use
+untagged_resource_types = ['elasticache', 'rds']
+
+# What threshold and `when` expressions can use besides the resource's own
+# variables (cpu, cph, ram, allocated_storage)
+expression_globals = { '__builtins__': {}, 'int': int, 'float': float, 'min': min, 'max': max,
+                       'kb': 1024, 'mb': 1048576, 'gb': 1073741824, 'tb': 1099511627776 }
+
+def load_policy(path):
+    with open(path) as infile:
+        if path.endswith('.yml') or path.endswith('.yaml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML is needed to read %s" % path)
+            return yaml.safe_load(infile)
+        return json.load(infile)
+
+def rule_name(rule):
+    return rule.get('name', rule.get('metric'))
+
+def merge_account_overrides(policy, profile_name):
+    # The "accounts" section is keyed by profile name and has the same shape
+    # as the top level.  Resource type settings replace the base ones, and
+    # rules are matched up by name; "disabled": true drops a rule.
+    overrides = policy.get('accounts', {}).get(profile_name)
+    if not overrides:
+        return policy
+    merged = copy.deepcopy(policy)
+    merged.setdefault('defaults', {}).update(overrides.get('defaults', {}))
+    merged['exclude_alarm_names'] = merged.get('exclude_alarm_names', []) + overrides.get('exclude_alarm_names', [])
+    for resource_type, type_overrides in overrides.get('resource_types', {}).items():
+        base = merged.setdefault('resource_types', {}).setdefault(resource_type, {})
+        rules = base.setdefault('rules', [])
+        for key, value in type_overrides.items():
+            if key != 'rules':
+                base[key] = value
+        for rule in type_overrides.get('rules', []):
+            existing = [ r for r in rules if rule_name(r) == rule_name(rule) ]
+            if existing:
+                existing[0].update(rule)
+            else:
+                rules.append(rule)
+    return merged
+
+def compile_threshold(threshold, where):
+    # Numbers and human readable sizes ('300mb') are constants; anything else
+    # is an expression over the resource's variables.
+    if not isinstance(threshold, basestring):
+        return metric_human_readable(threshold)
+    if re.match(r'^\d+\s*[a-zA-Z]*$', threshold):
+        value = metric_human_readable(re.sub(r'\s+', '', threshold))
+        if value is None:
+            raise ValueError("%s: can't make sense of %r" % (where, threshold))
+        return value
+    return compile(threshold, where, 'eval')
+
+class ThresholdError(ValueError):
+    pass
+
+class CompiledRule(object):
+    def __init__(self, spec, defaults, where):
+        unknown = set(spec) - rule_keys
+        if unknown:
+            raise ValueError("Unknown keys in %s: %s" % (where, ', '.join(sorted(unknown))))
+        if 'metric' not in spec:
+            raise ValueError("%s has no metric" % where)
+        settings = dict(defaults)
+        settings.update(spec)
+        self.metric             = settings['metric']
+        self.name               = rule_name(settings)
+        self.namespace          = settings.get('namespace')
+        self.statistic          = settings['statistic']
+        self.comparison         = settings['comparison']
+        self.period             = int(settings['period'])
+        self.evaluation_periods = int(settings['evaluation_periods'])
+        self.threshold          = compile_threshold(settings['threshold'], '%s threshold' % where)
+        self.when               = None
+        if settings.get('when'):
+            self.when = compile(settings['when'], '%s when' % where, 'eval')
+        # With group_by (a tag name), resources sharing a value of that tag
+        # get one metric-math alarm between them instead of one each
+        self.group_by           = settings.get('group_by')
+        self.aggregate          = settings.get('aggregate', 'MAX').upper()
+        if self.aggregate not in math_aggregates:
+            raise ValueError("%s: aggregate must be one of %s" % (where, ', '.join(math_aggregates)))
+
+    def threshold_for(self, resource_name, variables):
+        # The rule's threshold for this resource, or None if it doesn't apply.
+        # Raises ThresholdError if the expressions can't be evaluated.
+        try:
+            if self.when is not None and not eval(self.when, expression_globals, variables):
+                return None
+            if hasattr(self.threshold, 'co_code'):
+                return metric_human_readable(eval(self.threshold, expression_globals, variables))
+            return self.threshold
+        except (NameError, TypeError, ValueError, ZeroDivisionError) as e:
+            raise ThresholdError("can't work out the %s threshold for %s: %s" % (self.name, resource_name, e))
+
+class CompiledResourcePolicy(object):
+    def __init__(self, resource_type, spec, defaults):
+        where = "resource type %s" % resource_type
+        unknown = set(spec) - resource_type_keys
+        if unknown:
+            raise ValueError("Unknown keys in %s: %s" % (where, ', '.join(sorted(unknown))))
+        self.resource_type  = resource_type
+        self.prefix         = spec.get('prefix', resource_type)
+        self.dimension_name = spec['dimension_name']
+        self.include_names  = [ re.compile(p) for p in spec.get('include_names', []) ]
+        self.exclude_names  = [ re.compile(p) for p in spec.get('exclude_names', []) ]
+        self.include_tags   = dict((k, re.compile(v)) for k, v in spec.get('include_tags', {}).items())
+        self.exclude_tags   = dict((k, re.compile(v)) for k, v in spec.get('exclude_tags', {}).items())
+        # "resource", or a tag name: roll each resource's (or each tag
+        # value's) alarms up into one composite alarm that does the notifying
+        self.composite_by   = spec.get('composite_by')
+
+        # Rule settings given on the resource type are defaults for its rules
+        type_defaults = dict(defaults)
+        type_defaults.update((k, v) for k, v in spec.items() if k in rule_keys)
+        self.rules = [ CompiledRule(rule, type_defaults, "%s rule %s" % (resource_type, rule_name(rule)))
+                       for rule in spec.get('rules', []) if not rule.get('disabled') ]
+
+        if resource_type in untagged_resource_types:
+            tag_keys = [ k for k in ('include_tags', 'exclude_tags') if spec.get(k) ]
+            if self.composite_by not in (None, 'resource'):
+                tag_keys.append('composite_by')
+            if any(rule.group_by for rule in self.rules):
+                tag_keys.append('group_by')
+            if tag_keys:
+                raise ValueError("%s: %s need tags, which %s resources don't come with" %
+                                 (where, ', '.join(tag_keys), resource_type))
+
+    def matches(self, name, tags):
+        if self.include_names and not any(p.search(name) for p in self.include_names):
+            return False
+        if any(p.search(name) for p in self.exclude_names):
+            return False
+        for tag, pattern in self.include_tags.items():
+            if not pattern.search(tags.get(tag) or ''):
+                return False
+        for tag, pattern in self.exclude_tags.items():
+            if tag in tags and pattern.search(tags[tag]):
+                return False
+        return True
+
+    def composite_key(self, alarm_id, tags):
+        # What this resource's alarms get rolled up under, if anything.
+        # alarm_id is as for alarm_name().
+        if self.composite_by == 'resource':
+            if isinstance(alarm_id, basestring):
+                return alarm_id
+            return alarm_id[-1]
+        if self.composite_by:
+            return tags.get(self.composite_by)
+        return None
+
+class CompiledPolicy(object):
+    def __init__(self, policy, profile_name):
+        policy = merge_account_overrides(policy, profile_name)
+        for resource_type in policy.get('resource_types', {}):
+            if resource_type not in resource_type_order:
+                raise ValueError("Unknown resource type %s in policy" % resource_type)
+        self.exclude_alarm_names = [ re.compile(p) for p in policy.get('exclude_alarm_names', []) ]
+        self.resource_types = [ CompiledResourcePolicy(t, policy['resource_types'][t], policy.get('defaults', {}))
+                                for t in resource_type_order if t in policy.get('resource_types', {}) ]
+
+# Instance type catalog
+#
+# vCPUs, CPU credits earned per hour (burstable types only) and memory (GiB)
+# per instance type, loaded once from instance_types.json.  Sizes missing
+# from the file are derived from another size in the same family.  Regenerate
+# the file from an instance dump with --refresh-instance-catalog.
+
+default_instance_catalog_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance_types.json')
+
+# How big each size is relative to the others (AWS's normalization factors)
+size_factors = { 'nano': 0.25, 'micro': 0.5, 'small': 1, 'medium': 2, 'large': 4, 'xlarge': 8 }
+
+def size_factor(size):
+    if size in size_factors:
+        return size_factors[size]
+    match = re.match(r'^(\d+)xlarge$', size)
+    if match:
+        return 8 * int(match.group(1))
+    return None
+
+class InstanceType(object):
+    __slots__ = ('name', 'family', 'size', 'cpu', 'cph', 'ram')
+
+    def __init__(self, name, cpu, cph, ram):
+        family, _, size = name.partition('.')
+        for attr, value in zip(self.__slots__, (name, family, size, cpu, cph, ram)):
+            object.__setattr__(self, attr, value)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("InstanceType records are read-only")
+
+    def __repr__(self):
+        return 'InstanceType:%s[cpu=%s cph=%s ram=%s]' % (self.name, self.cpu, self.cph, self.ram)
+
+class InstanceCatalog(object):
+    def __init__(self, types):
+        # types is {name: {"vcpu", "cph", "memory"}}, as in instance_types.json
+        self.families = {}
+        for name, spec in types.items():
+            instance_type = InstanceType(str(name), spec["vcpu"], spec["cph"], spec["memory"])
+            self.families.setdefault(instance_type.family, {})[instance_type.size] = instance_type
+        self.unknown = set()
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as infile:
+            return cls(json.load(infile)["types"])
+
+    def lookup(self, instance_type):
+        # Returns the InstanceType, or None (warning once) if it's not in the
+        # catalog and can't be derived
+        instance_type = instance_type.replace("db.", '').replace("cache.", '')
+        family, _, size = instance_type.partition('.')
+        sizes = self.families.get(family, {})
+        if size not in sizes:
+            derived = self.derive(instance_type, sizes)
+            if derived is None:
+                if instance_type not in self.unknown:
+                    logging.warn("Don't know the specs of instance type %s; skipping alarms that need them." % instance_type)
+                    self.unknown.add(instance_type)
+                return None
+            sizes[size] = derived
+        return sizes[size]
+
+    def derive(self, instance_type, sizes):
+        # Scale the nearest known size in the same family
+        factor = size_factor(instance_type.partition('.')[2])
+        known = [ t for t in sizes.values() if size_factor(t.size) ]
+        if factor is None or not known:
+            return None
+        base = min(known, key=lambda t: abs(size_factor(t.size) - factor))
+        ratio = float(factor) / size_factor(base.size)
+        cph = None
+        if base.cph is not None:
+            cph = int(base.cph * ratio)
+        logging.info("Deriving specs for %s from %s" % (instance_type, base.name))
+        return InstanceType(instance_type, max(1, int(round(base.cpu * ratio))), cph, base.ram * ratio)
+
+instance_catalog = InstanceCatalog.load(default_instance_catalog_file)
+
 def instance_stats(instance_type):
-    ec2_instance_types = {
-        "t2.nano"     : { "vCPU":  1, "cph":    3, "Memory" :  0.5 },
-        "t2.micro"    : { "vCPU":  1, "cph":    6, "Memory" :    1 },
-        "t2.small"    : { "vCPU":  1, "cph":   12, "Memory" :    4 },
-        "t2.medium"   : { "vCPU":  2, "cph":   24, "Memory" :    4 },
-        "t2.large"    : { "vCPU":  2, "cph":   36, "Memory" :    8 },
-        "t2.xlarge"   : { "vCPU":  4, "cph":   54, "Memory" :   16 },
-        "t2.2xlarge"  : { "vCPU":  8, "cph":   81, "Memory" :   32 },
-        "t3.nano"     : { "vCPU":  1, "cph":    3, "Memory" :  0.5 },
-        "t3.micro"    : { "vCPU":  1, "cph":    6, "Memory" :    1 },
-        "t3.small"    : { "vCPU":  1, "cph":   12, "Memory" :    4 },
-        "t3.medium"   : { "vCPU":  2, "cph":   24, "Memory" :    4 },
-        "t3.large"    : { "vCPU":  2, "cph":   36, "Memory" :    8 },
-        "t3.xlarge"   : { "vCPU":  4, "cph":   54, "Memory" :   16 },
-        "t3.2xlarge"  : { "vCPU":  8, "cph":   81, "Memory" :   32 },
-        "m3.medium"   : { "vCPU":  2, "cph": None, "Memory" : 3.75 },
-        "m3.large"    : { "vCPU":  2, "cph": None, "Memory" :  7.5 },
-        "m3.xlarge"   : { "vCPU":  2, "cph": None, "Memory" :   15 },
-        "m3.2xlarge"  : { "vCPU":  2, "cph": None, "Memory" :   30 },
-        "m4.large"    : { "vCPU":  2, "cph": None, "Memory" :    8 },
-        "m4.xlarge"   : { "vCPU":  2, "cph": None, "Memory" :   16 },
-        "m4.2xlarge"  : { "vCPU":  2, "cph": None, "Memory" :   32 },
-        "m4.4xlarge"  : { "vCPU":  2, "cph": None, "Memory" :   64 },
-        "m4.10xlarge" : { "vCPU":  2, "cph": None, "Memory" :  160 },
-        "m4.16xlarge" : { "vCPU":  2, "cph": None, "Memory" :  256 },
-        "m5.large"    : { "vCPU":  2, "cph": None, "Memory" :    8 },
-        "m5.xlarge"   : { "vCPU":  2, "cph": None, "Memory" :   16 },
-        "m5.2xlarge"  : { "vCPU":  2, "cph": None, "Memory" :   32 },
-        "m5.4xlarge"  : { "vCPU":  2, "cph": None, "Memory" :   64 },
-        "m5.10xlarge" : { "vCPU":  2, "cph": None, "Memory" :  160 },
-        "m5.16xlarge" : { "vCPU":  2, "cph": None, "Memory" :  256 },
-        "c3.large"    : { "vCPU":  2, "cph": None, "Memory" : 3.75 },
-        "c3.xlarge"   : { "vCPU":  4, "cph": None, "Memory" :  7.5 },
-        "c3.2xlarge"  : { "vCPU":  8, "cph": None, "Memory" :   15 },
-        "c3.4xlarge"  : { "vCPU": 16, "cph": None, "Memory" :   30 },
-        "c3.8xlarge"  : { "vCPU": 32, "cph": None, "Memory" :   60 },
-        "c4.large"    : { "vCPU":  2, "cph": None, "Memory" : 3.75 },
-        "c4.xlarge"   : { "vCPU":  4, "cph": None, "Memory" :  7.5 },
-        "c4.2xlarge"  : { "vCPU":  8, "cph": None, "Memory" :   15 },
-        "c4.4xlarge"  : { "vCPU": 16, "cph": None, "Memory" :   30 },
-        "c4.8xlarge"  : { "vCPU": 36, "cph": None, "Memory" :   60 },
-        "c5.large"    : { "vCPU":  2, "cph": None, "Memory" : 3.75 },
-        "c5.xlarge"   : { "vCPU":  4, "cph": None, "Memory" :  7.5 },
-        "c5.2xlarge"  : { "vCPU":  8, "cph": None, "Memory" :   15 },
-        "c5.4xlarge"  : { "vCPU": 16, "cph": None, "Memory" :   30 },
-        "c5.9xlarge"  : { "vCPU": 36, "cph": None, "Memory" :   72 },
-        "r3.large"    : { "vCPU":  2, "cph": None, "Memory" :15.25 },
-        "r3.xlarge"   : { "vCPU":  4, "cph": None, "Memory" : 30.5 },
-        "r3.2xlarge"  : { "vCPU":  8, "cph": None, "Memory" :   61 },
-        "r3.4xlarge"  : { "vCPU": 16, "cph": None, "Memory" :  122 },
-        "r3.8xlarge"  : { "vCPU": 32, "cph": None, "Memory" :  244 },
-        "r4.large"    : { "vCPU":  2, "cph": None, "Memory" :15.25 },
-        "r4.xlarge"   : { "vCPU":  4, "cph": None, "Memory" : 30.5 },
-        "r4.2xlarge"  : { "vCPU":  8, "cph": None, "Memory" :   61 },
-        "r4.4xlarge"  : { "vCPU": 16, "cph": None, "Memory" :  122 },
-        "r4.8xlarge"  : { "vCPU": 32, "cph": None, "Memory" :  244 },
-        "r4.16xlarge" : { "vCPU": 64, "cph": None, "Memory" :  488 },
-        "r5.large"    : { "vCPU":  2, "cph": None, "Memory" :15.25 },
-        "r5.xlarge"   : { "vCPU":  4, "cph": None, "Memory" : 30.5 },
-        "r5.2xlarge"  : { "vCPU":  8, "cph": None, "Memory" :   61 },
-        "r5.4xlarge"  : { "vCPU": 16, "cph": None, "Memory" :  122 },
-        "r5.8xlarge"  : { "vCPU": 32, "cph": None, "Memory" :  244 },
-        "r5.16xlarge" : { "vCPU": 64, "cph": None, "Memory" :  488 },
-        "x1.16xlarge" : { "vCPU": 64, "cph": None, "Memory" :  976 },
-        "x1.32xlarge" : { "vCPU":128, "cph": None, "Memory" : 1952 }
-    }
-    class instance_obj():
-        pass
+    return instance_catalog.lookup(instance_type)
 
-    instance_type = instance_type.replace("db.", '')
-    i = instance_obj()
-    i.cpu = ec2_instance_types[instance_type]["vCPU"]
-    i.cph = ec2_instance_types[instance_type]["cph"]
-    # I found that my r3.large instances don't have CPUCreditBalances, so I needed
-    # to not give them a default amount.  Added check so only RDS inst. w/cph will 
-    # get the alarm.
-    if i.cph is None and not any(word in instance_type for word in ['r3.large']):
-        i.cph = 50
-    i.ram = ec2_instance_types[instance_type]["Memory"]
-    return i
+def parse_instance_dump(dump):
+    # Yields (instance type, vCPUs, memory in GiB, burstable) from either
+    # `aws ec2 describe-instance-types` output, an AWS pricing offer file, or
+    # a list of {"instance_type", "vCPU", "memory"} objects (ec2instances.info)
+    if isinstance(dump, dict) and "InstanceTypes" in dump:
+        for t in dump["InstanceTypes"]:
+            yield (t["InstanceType"], t["VCpuInfo"]["DefaultVCpus"], t["MemoryInfo"]["SizeInMiB"] / 1024.0,
+                   t.get("BurstablePerformanceSupported", False))
+    elif isinstance(dump, dict) and "products" in dump:
+        for product in dump["products"].values():
+            attributes = product.get("attributes", {})
+            if "instanceType" in attributes and "vcpu" in attributes and "memory" in attributes:
+                memory = attributes["memory"].split()[0].replace(',', '')
+                yield (attributes["instanceType"], int(attributes["vcpu"]), float(memory),
+                       attributes["instanceType"].startswith('t'))
+    elif isinstance(dump, list):
+        for t in dump:
+            yield t["instance_type"], int(t["vCPU"]), float(t["memory"]), t["instance_type"].startswith('t')
+    else:
+        raise ValueError("Don't recognise the instance dump format")
 
-# Get list of instances
-def get_ec2_instances(profile_name):
-    ec2 = boto.ec2.connect_to_region(region,profile_name=profile_name)
-    reservations = ec2.get_all_reservations()
-    inst = []
-    for reservation in reservations:
-        for instance in reservation.instances:
+def write_atomically(path, text):
+    # Readers (cron jobs, the Prometheus textfile collector) never see half a file
+    with open(path + '.tmp', 'w') as outfile:
+        outfile.write(text)
+    os.rename(path + '.tmp', path)
+
+def write_instance_catalog(types, path):
+    def order(name):
+        family, _, size = name.partition('.')
+        return (family, size_factor(size) or 0, size)
+    lines = []
+    for name in sorted(types, key=order):
+        spec = types[name]
+        lines.append('        %-15s { "vcpu": %3d, "cph": %4s, "memory": %6s }' %
+                     ('"%s":' % name, spec["vcpu"], json.dumps(spec["cph"]), json.dumps(spec["memory"])))
+    write_atomically(path, '{\n    "types": {\n' + ',\n'.join(lines) + '\n    }\n}\n')
+
+def refresh_instance_catalog(dump_path, catalog_path=default_instance_catalog_file):
+    # Dumps don't include CPU credit rates, so those are carried over from
+    # the current catalog.  Types missing from the dump are kept.
+    with open(catalog_path) as infile:
+        types = json.load(infile)["types"]
+    with open(dump_path) as infile:
+        dump = json.load(infile)
+    for name, cpu, memory, burstable in parse_instance_dump(dump):
+        if '.' not in name:
+            continue
+        cph = types.get(name, {}).get("cph")
+        if burstable and cph is None:
+            logging.warn("No CPU credit rate known for burstable type %s; add it to %s by hand." % (name, catalog_path))
+        if memory == int(memory):
+            memory = int(memory)
+        types[name] = { "vcpu": cpu, "cph": cph, "memory": memory }
+    write_instance_catalog(types, catalog_path)
+    return len(types)
+
+# Backends
+#
+# Every AWS connection is made through `backend`, so something else can stand
+# in for AWS by providing the same connection methods (fake_aws.FakeBackend
+# does, for benchmarking without an account).
+
+class BotoBackend(object):
+    def cloudwatch(self, region, profile_name):
+        return boto.ec2.cloudwatch.connect_to_region(region, profile_name=profile_name)
+
+    def ec2(self, region, profile_name):
+        return boto.ec2.connect_to_region(region, profile_name=profile_name)
+
+    def elasticache(self, region, profile_name):
+        return boto.elasticache.connect_to_region(region, profile_name=profile_name)
+
+    def rds(self, region, profile_name):
+        return boto.rds.connect_to_region(region, profile_name=profile_name)
+
+    def elb(self, region, profile_name):
+        return boto.ec2.elb.connect_to_region(region, profile_name=profile_name)
+
+    def sqs(self, region, profile_name):
+        return boto.sqs.connect_to_region(region, profile_name=profile_name)
+
+backend = BotoBackend()
+
+# Run instrumentation
+#
+# Connections from connect() time every API call into run_stats, by service
+# and action (e.g. cloudwatch.ListMetrics), along with throttles and other
+# errors.  manage_alarms() also marks the phases of a run and tallies what
+# it did per resource type; the lot goes in the run report (--report,
+# --prometheus).
+
+# boto connection methods that make an API call, and the action they call
+api_methods = { 'list_metrics': 'ListMetrics', 'put_metric_alarm': 'PutMetricAlarm', 'delete_alarms': 'DeleteAlarms',
+                'describe_alarms': 'DescribeAlarms', 'get_all_reservations': 'DescribeInstances',
+                'get_all_dbinstances': 'DescribeDBInstances', 'describe_cache_clusters': 'DescribeCacheClusters',
+                'get_all_load_balancers': 'DescribeLoadBalancers', 'get_queue': 'GetQueueUrl',
+                'receive_message': 'ReceiveMessage', 'delete_message_batch': 'DeleteMessageBatch' }
+# ... and the ones that take the action as their first argument
+api_action_methods = [ 'get_list', 'get_object', 'get_status' ]
+
+class RunStats(object):
+    # Upper bounds (seconds) of the API latency histogram buckets; there's
+    # an implicit +Inf bucket after them
+    latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.current_phase = None
+        self.phase_started = None
+        self.operations = {}
+        self.tallies = {}
+
+    def phase(self, name):
+        # Start timing phase `name` (None for none), ending the previous one
+        now = time.time()
+        with self.lock:
+            if self.current_phase:
+                self.phases[self.current_phase] = self.phases.get(self.current_phase, 0) + now - self.phase_started
+            self.current_phase, self.phase_started = name, now
+
+    def record(self, operation, seconds, error=None):
+        with self.lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = { "calls": 0, "seconds": 0.0, "throttles": 0, "errors": 0,
+                                                       "buckets": [0] * (len(self.latency_buckets) + 1) }
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["buckets"][bisect.bisect_left(self.latency_buckets, seconds)] += 1
+            if isinstance(error, BotoServerError) and is_throttle(error):
+                stats["throttles"] += 1
+            elif error is not None:
+                stats["errors"] += 1
+
+    def tally(self, resource_type, action, count=1):
+        with self.lock:
+            counts = self.tallies.setdefault(resource_type, {})
+            counts[action] = counts.get(action, 0) + count
+
+    def report(self):
+        self.phase(None)
+        operations = {}
+        for name, stats in self.operations.items():
+            cumulative = 0
+            buckets = []
+            for bound, count in zip(self.latency_buckets + ['+Inf'], stats["buckets"]):
+                cumulative += count
+                buckets.append([bound, cumulative])
+            operations[name] = dict(stats, buckets=buckets)
+        return { "started": self.started, "wall_time": time.time() - self.started, "phases": dict(self.phases),
+                 "operations": operations, "alarms": self.tallies }
+
+run_stats = RunStats()
+
+class InstrumentedConnection(object):
+    # Passes everything through to `connection`, timing API calls
+    def __init__(self, connection, service):
+        self.connection = connection
+        self.service = service
+
+    def __getattr__(self, name):
+        method = getattr(self.connection, name)
+        if name in api_action_methods:
+            return lambda action, *args, **kwargs: self.call(action, method, action, *args, **kwargs)
+        if name in api_methods:
+            return lambda *args, **kwargs: self.call(api_methods[name], method, *args, **kwargs)
+        return method
+
+    def call(self, action, method, *args, **kwargs):
+        started = time.time()
+        try:
+            result = method(*args, **kwargs)
+        except Exception as e:
+            run_stats.record('%s.%s' % (self.service, action), time.time() - started, e)
+            raise
+        run_stats.record('%s.%s' % (self.service, action), time.time() - started)
+        return result
+
+def connect(service, region, profile_name):
+    # service is a backend method name: cloudwatch, ec2, elasticache, rds, elb or sqs
+    return InstrumentedConnection(getattr(backend, service)(region, profile_name), service)
+
+def is_throttle(e):
+    return e.status == 429 or e.error_code in ['Throttling', 'ThrottlingException', 'RequestLimitExceeded']
+
+class TokenBucket(object):
+    # Rate limiter for the mutating CloudWatch calls.  Halves the rate when we
+    # get throttled and creeps it back up (by `ramp` calls/sec) on every
+    # success, so we settle just under whatever the account's quota is.
+    # Several workers usually hit the same throttle at once, so the rate is
+    # only cut once per `cooldown` seconds.
+    def __init__(self, rate, max_rate, min_rate=0.5, ramp=0.1, cooldown=1.0):
+        self.rate = min(rate, max_rate)
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, self.rate)
+        self.ramp = ramp
+        self.cooldown = cooldown
+        self.last_cut = 0
+        self.tokens = 1.0
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            now = time.time()
+            if now - self.last_cut >= self.cooldown:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.last_cut = now
+            self.tokens = 0
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.ramp)
+
+class MutationExecutor(object):
+    # Runs alarm creates/deletes on a pool of threads, all drawing from one
+    # TokenBucket.  Each thread gets its own CloudWatch connection from
+    # connection_factory, since boto connections shouldn't be shared.
+    #
+    # Operations are submitted as a connection method name (or a function
+    # taking the connection) plus arguments, e.g.
+    # submit("Creating alarm x", "put_metric_alarm", alarm).
+    def __init__(self, connection_factory, workers=8, rate=3.0, max_rate=20.0,
+                 max_retries=8, backoff_base=0.5, backoff_cap=30):
+        self.connection_factory = connection_factory
+        self.bucket = TokenBucket(rate, max_rate)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.local = threading.local()
+        self.pool = ThreadPool(workers)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.completed = 0
+        self.throttled = 0
+        self.failed = 0
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = self.connection_factory()
+        return self.local.connection
+
+    def submit(self, description, method, *args):
+        self.pending.append(self.pool.apply_async(self.run, (description, method, args)))
+
+    def wait(self):
+        # Block until everything submitted so far is done, for calls that
+        # depend on earlier ones having happened
+        while self.pending:
+            self.pending.pop().wait()
+
+    def run(self, description, method, args):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
             try:
-                instance.name = instance.tags['Name']
-            except:
-                instance.name = None
-            instance.nametag = instance.id
-            inst.append(instance)
-    return inst
-
-def get_elasticache_instances(profile_name):
-    ec = boto.elasticache.connect_to_region(region,profile_name=profile_name)
-    ec_clusters = []
-    class ec_obj():
+                if attempt == 0:
+                    logging.warn(description)
+                if callable(method):
+                    method(self.connection(), *args)
+                else:
+                    getattr(self.connection(), method)(*args)
+            except BotoServerError as e:
+                if is_throttle(e) and attempt < self.max_retries:
+                    self.bucket.throttled()
+                    with self.lock:
+                        self.throttled += 1
+                    # Exponential backoff with full jitter
+                    delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+                    logging.info("Throttled on %s; retrying in %.2fs" % (getattr(method, '__name__', method), delay))
+                    time.sleep(delay)
+                    continue
+                logging.error("%s failed: %s" % (description, e))
+                with self.lock:
+                    self.failed += 1
+                return
+            except Exception as e:
+                logging.error("%s failed: %s" % (description, e))
+                with self.lock:
+                    self.failed += 1
+                return
+            self.bucket.succeeded()
+            with self.lock:
+                self.completed += 1
+            return
+
+    def join(self):
+        # Wait for everything submitted so far and report how fast we went
+        self.pool.close()
+        self.pool.join()
+        elapsed = time.time() - self.started
+        ops_per_sec = self.completed / max(elapsed, 0.001)
+        if self.completed or self.failed:
+            logging.warn("Made %s alarm changes (%s failed, %s throttled) in %.1fs: %.2f ops/sec" %
+                         (self.completed, self.failed, self.throttled, elapsed, ops_per_sec))
+        return { "completed": self.completed, "failed": self.failed, "throttled": self.throttled,
+                 "elapsed": elapsed, "ops_per_sec": ops_per_sec }
+
+class Resource(object):
+    # Lightweight record of a discovered resource: all the policy and the
+    # cache need to know about it
+    __slots__ = ('id', 'name', 'instance_class', 'allocated_storage', 'tags', 'state')
+
+    def __init__(self, id, name=None, instance_class=None, allocated_storage=None, tags=None, state=None):
+        self.id                = id
+        self.name              = name
+        self.instance_class    = instance_class
+        self.allocated_storage = allocated_storage
+        self.tags              = tags or {}
+        self.state             = state
+
+    def to_json(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    @classmethod
+    def from_json(cls, record):
+        return cls(**dict((str(k), v) for k, v in record.items()))
+
+def prefetch(iterable, depth=1000):
+    # Run a generator in a background thread, up to `depth` items ahead, so
+    # whoever's consuming it can work on one page while the next is fetched.
+    # Exceptions in the generator are re-raised in the consumer.
+    items = six.moves.queue.Queue(depth)
+    done = object()
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+            items.put((done, None))
+        except Exception:
+            items.put((done, sys.exc_info()))
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    while True:
+        item, exc_info = items.get()
+        if exc_info:
+            six.reraise(*exc_info)
+        if item is done:
+            return
+        yield item
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Discovery
+#
+# The get_* helpers are generators that page through the describe calls and
+# yield Resource records as each page arrives, so nothing holds a whole
+# account's worth of boto objects.  Given a resource_id they describe just
+# that one resource.
+
+# Get list of instances
+def get_ec2_instances(profile_name, region, filters=None, resource_id=None):
+    ec2 = connect('ec2', region, profile_name)
+    if resource_id:
+        filters = { 'instance-id': [resource_id] }
+    next_token = None
+    while True:
+        reservations = ec2.get_all_reservations(filters=filters, max_results=1000, next_token=next_token)
+        for reservation in reservations:
+            for instance in reservation.instances:
+                yield Resource(instance.id, instance.tags.get('Name'), instance.instance_type,
+                               tags=dict(instance.tags), state=instance.state)
+        next_token = reservations.next_token
+        if not next_token:
+            break
+
+def get_elasticache_instances(profile_name, region, resource_id=None):
+    ec = connect('elasticache', region, profile_name)
+    marker = None
+    while True:
+        result = ec.describe_cache_clusters(cache_cluster_id=resource_id, max_records=100,
+                                            marker=marker).values()[0]['DescribeCacheClustersResult']
+        for cluster in result['CacheClusters']:
+            yield Resource(str(cluster['CacheClusterId']), instance_class=cluster.get('CacheNodeType'))
+        marker = result.get('Marker')
+        if not marker:
+            break
+
+def get_rds_instances(profile_name, region, resource_id=None):
+    rds = connect('rds', region, profile_name)
+    marker = None
+    while True:
+        instances = rds.get_all_dbinstances(instance_id=resource_id, max_records=100, marker=marker)
+        for instance in instances:
+            yield Resource(str(instance.id), instance_class=instance.instance_class,
+                           allocated_storage=instance.allocated_storage)
+        marker = instances.marker
+        if not marker:
+            break
+
+def get_elb_instances(profile_name, region, resource_id=None):
+    elb = connect('elb', region, profile_name)
+    marker = None
+    while True:
+        load_balancers = elb.get_all_load_balancers(load_balancer_names=[resource_id] if resource_id else None,
+                                                    marker=marker)
+        # DescribeTags takes up to 20 names
+        tags = {}
+        for names in chunks([ lb.name for lb in load_balancers ], 20):
+            params = {}
+            elb.build_list_params(params, names, 'LoadBalancerNames.member')
+            for description in elb.get_list('DescribeTags', params, [('member', LoadBalancerTags)]):
+                tags[description.name] = dict(description.tags)
+        for instance in load_balancers:
+            yield Resource(instance.name, tags=tags.get(instance.name))
+        marker = load_balancers.next_marker
+        if not marker:
+            break
+
+class ResourceTags(dict):
+    # Key/Value members, as DescribeTags has them
+    def startElement(self, name, attrs, connection):
         pass
-    for cluster in ec.describe_cache_clusters().values()[0]['DescribeCacheClustersResult']['CacheClusters']:
-        c = ec_obj()
-        c.nametag = str(cluster['CacheClusterId'])
-        c.cluster = cluster
-        ec_clusters.append(c)
-    return ec_clusters
-
-def get_rds_instances(profile_name):
-    rds = boto.rds.connect_to_region(region,profile_name=profile_name)
-    rds_instances = []
-    for instance in rds.get_all_dbinstances():
-        instance.nametag = str(instance.id)
-        rds_instances.append(instance)
-    return rds_instances
-
-def get_elb_instances(profile_name):
-    elb = boto.ec2.elb.connect_to_region(region,profile_name=profile_name)
-    elb_instances = []
-    for instance in elb.get_all_load_balancers():
-        instance.nametag = instance.name
-        elb_instances.append(instance)
-    return elb_instances
 
-def get_alarms(cloudwatch_connection):
-    alarm_obj = cloudwatch_connection.describe_alarms()
-    active_alarms = [ x.name for x in alarm_obj ]
+    def endElement(self, name, value, connection):
+        if name == 'Key':
+            self.key = value
+            self[value] = ''
+        elif name == 'Value':
+            self[self.key] = value
+
+class LoadBalancerTags(object):
+    # One of DescribeTags' TagDescriptions, which boto doesn't do for ELBs
+    def __init__(self, connection=None):
+        self.name = None
+        self.tags = ResourceTags()
+
+    def startElement(self, name, attrs, connection):
+        if name == 'Tags':
+            return self.tags
+
+    def endElement(self, name, value, connection):
+        if name == 'LoadBalancerName':
+            self.name = value
+
+# boto predates metric-math and composite alarms, so DescribeAlarms is parsed
+# with these instead of MetricAlarm, and they're put with put_alarm()
+
+class MetricQuery(dict):
+    # One entry of a metric-math alarm's Metrics: either an expression (id,
+    # expression, label) or a metric (id, metric, namespace, dimensions,
+    # statistic, period), plus return_data
+    fields = { 'Id': 'id', 'Expression': 'expression', 'Label': 'label', 'MetricName': 'metric',
+               'Namespace': 'namespace', 'Stat': 'statistic' }
+
+    def startElement(self, name, attrs, connection):
+        if name == 'Dimensions':
+            self['dimensions'] = Dimension()
+            return self['dimensions']
+
+    def endElement(self, name, value, connection):
+        if name == 'Period':
+            self['period'] = int(value)
+        elif name == 'ReturnData':
+            self['return_data'] = value == 'true'
+        elif name in self.fields:
+            self[self.fields[name]] = value
+
+class MetricQueries(list):
+    def startElement(self, name, attrs, connection):
+        if name == 'member':
+            query = MetricQuery()
+            self.append(query)
+            return query
+
+    def endElement(self, name, value, connection):
+        pass
+
+class ManagedAlarm(MetricAlarm):
+    # A MetricAlarm that can also be a metric-math alarm (metrics is a list
+    # of MetricQuery-shaped dicts) or a composite alarm (alarm_rule)
+    def __init__(self, connection=None, metrics=None, alarm_rule=None, **kwargs):
+        MetricAlarm.__init__(self, connection, **kwargs)
+        self.metrics = metrics
+        self.alarm_rule = alarm_rule
+
+    def startElement(self, name, attrs, connection):
+        if name == 'Metrics':
+            self.metrics = MetricQueries()
+            return self.metrics
+        return MetricAlarm.startElement(self, name, attrs, connection)
+
+    def endElement(self, name, value, connection):
+        if name == 'AlarmRule':
+            self.alarm_rule = value
+        else:
+            MetricAlarm.endElement(self, name, value, connection)
+
+class ManagedAlarms(list):
+    def __init__(self, connection=None):
+        list.__init__(self)
+        self.connection = connection
+
+    def startElement(self, name, attrs, connection):
+        if name == 'member':
+            alarm = ManagedAlarm(connection)
+            self.append(alarm)
+            return alarm
+
+    def endElement(self, name, value, connection):
+        pass
+
+def is_composite(alarm):
+    return bool(getattr(alarm, 'alarm_rule', None))
+
+def describe_alarms(cloudwatch_connection, state_value=None, name_prefix=None):
+    # Yields every alarm, metric, metric-math and composite
+    params = { 'AlarmTypes.member.1': 'MetricAlarm', 'AlarmTypes.member.2': 'CompositeAlarm' }
+    if state_value:
+        params['StateValue'] = state_value
+    if name_prefix:
+        params['AlarmNamePrefix'] = name_prefix
     # describe_alarms paginates so we have to take effort to get them all
-    while alarm_obj.next_token:
-        alarm_obj = cloudwatch_connection.describe_alarms(next_token=alarm_obj.next_token)
-        active_alarms += [x.name for x in alarm_obj]
+    while True:
+        result = cloudwatch_connection.get_list('DescribeAlarms', params,
+                                                [('MetricAlarms', ManagedAlarms), ('CompositeAlarms', ManagedAlarms)])
+        for alarms in result:
+            for alarm in alarms:
+                yield alarm
+        if not result.next_token:
+            break
+        params['NextToken'] = result.next_token
+
+def get_alarms(cloudwatch_connection):
+    # Returns the full alarm definitions, keyed by name
+    return dict((x.name, x) for x in describe_alarms(cloudwatch_connection))
+
+def alarm_action_params(cloudwatch_connection, params, alarm):
+    params['ActionsEnabled'] = 'true'
+    if alarm.alarm_actions:
+        cloudwatch_connection.build_list_params(params, alarm.alarm_actions, 'AlarmActions.member')
+    if alarm.ok_actions:
+        cloudwatch_connection.build_list_params(params, alarm.ok_actions, 'OKActions.member')
+
+def put_alarm(cloudwatch_connection, alarm):
+    if is_composite(alarm):
+        params = { 'AlarmName': alarm.name, 'AlarmRule': alarm.alarm_rule }
+        alarm_action_params(cloudwatch_connection, params, alarm)
+        return cloudwatch_connection.get_status('PutCompositeAlarm', params, verb='POST')
+    if not getattr(alarm, 'metrics', None):
+        return cloudwatch_connection.put_metric_alarm(alarm)
+    params = { 'AlarmName': alarm.name, 'ComparisonOperator': alarm.comparison,
+               'Threshold': alarm.threshold, 'EvaluationPeriods': alarm.evaluation_periods }
+    alarm_action_params(cloudwatch_connection, params, alarm)
+    for i, query in enumerate(alarm.metrics):
+        member = 'Metrics.member.%s.' % (i + 1)
+        params[member + 'Id'] = query['id']
+        params[member + 'ReturnData'] = str(query['return_data']).lower()
+        if 'expression' in query:
+            params[member + 'Expression'] = query['expression']
+            if query.get('label'):
+                params[member + 'Label'] = query['label']
+            continue
+        params[member + 'MetricStat.Metric.MetricName'] = query['metric']
+        params[member + 'MetricStat.Metric.Namespace'] = query['namespace']
+        params[member + 'MetricStat.Period'] = query['period']
+        params[member + 'MetricStat.Stat'] = query['statistic']
+        dimensions = [ (k, v) for k, values in sorted(query['dimensions'].items()) for v in values ]
+        for j, (dimension_name, value) in enumerate(dimensions):
+            params[member + 'MetricStat.Metric.Dimensions.member.%s.Name' % (j + 1)] = dimension_name
+            params[member + 'MetricStat.Metric.Dimensions.member.%s.Value' % (j + 1)] = value
+    return cloudwatch_connection.get_status('PutMetricAlarm', params, verb='POST')
+
+def chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def alarm_comparison(alarm):
+    # MetricAlarm() stores the API's operator name but alarms read back from
+    # describe_alarms have the symbol; normalise to the symbol.
+    return MetricAlarm._rev_cmp_map.get(alarm.comparison, alarm.comparison)
+
+# The parts of an alarm we manage, for telling whether it needs updating
+def metric_queries(alarm):
+    return [ dict(q, **({ "dimensions": dict((k, list(v)) for k, v in q["dimensions"].items()) }
+                         if "dimensions" in q else {}))
+             for q in getattr(alarm, 'metrics', None) or [] ]
+
+def alarm_settings(alarm):
+    return { "metric": alarm.metric,
+             "namespace": alarm.namespace,
+             "statistic": alarm.statistic,
+             "comparison": alarm_comparison(alarm),
+             "threshold": alarm.threshold,
+             "period": alarm.period,
+             "evaluation_periods": alarm.evaluation_periods,
+             "dimensions": dict(alarm.dimensions or {}),
+             "alarm_actions": list(alarm.alarm_actions or []),
+             "ok_actions": list(alarm.ok_actions or []),
+             "metrics": metric_queries(alarm),
+             "alarm_rule": getattr(alarm, 'alarm_rule', None) }
+
+def alarm_resource_ids(alarm):
+    return sorted(sum((alarm.dimensions or {}).values(), []))
+
+class AlarmPlan(object):
+    # The desired-state diff for one (profile, region).  apply_alarms adds
+    # the alarms the policy wants to `desired`; compute() then works out
+    # what to create, update and delete against the alarms that exist, so a
+    # converged account makes no write calls at all.
+    def __init__(self, existing):
+        self.existing = existing
+        self.desired = {}
+        # Names we want but can't (or shouldn't) build right now, e.g. the
+        # metric hasn't reported yet.  Existing alarms by these names are left alone.
+        self.kept = set()
+        # ... of which, those waiting for their metric to first report
+        self.waiting = set()
+        # (dimension name, value) -> alarm name prefix for every resource the
+        # policy was evaluated against; used to find our own stale alarms
+        self.managed = {}
+        # Name prefixes of the group and composite alarms we own, which have
+        # no dimensions to go by, and their resource type
+        self.managed_prefixes = {}
+        # The resource type being evaluated, and the type of each alarm name
+        # added or kept, for the run report
+        self.resource_type = None
+        self.resource_types = {}
+        self.create = self.update = self.delete = self.unchanged = set()
+
+    def add(self, alarm):
+        # Resources can end up with the same alarm name, e.g. EC2 instances
+        # in an autoscaling group all have the same Name tag.  Keep the alarm
+        # for the lowest resource id, so which one wins doesn't depend on the
+        # order resources were listed in and flip from run to run.
+        other = self.desired.get(alarm.name)
+        if other is not None:
+            ids, other_ids = alarm_resource_ids(alarm), alarm_resource_ids(other)
+            if ids != other_ids:
+                logging.warn("%s and %s both want alarm %s; it goes to %s" %
+                             (', '.join(other_ids), ', '.join(ids), alarm.name, ', '.join(min(ids, other_ids))))
+            if other_ids <= ids:
+                return
+        self.desired[alarm.name] = alarm
+        self.resource_types[alarm.name] = self.resource_type
+
+    def keep(self, name):
+        self.kept.add(name)
+        self.resource_types[name] = self.resource_type
+
+    def wait_for_metric(self, name):
+        self.keep(name)
+        self.waiting.add(name)
+
+    def manage(self, dimension_name, resource_id, name_prefix):
+        self.managed[(dimension_name, resource_id)] = name_prefix
+
+    def manage_prefix(self, name_prefix):
+        self.managed_prefixes[name_prefix] = self.resource_type
+
+    def type_of(self, name):
+        if name in self.resource_types:
+            return self.resource_types[name]
+        for dimension_name in self.existing[name].dimensions or {}:
+            if dimension_name in dimension_types:
+                return dimension_types[dimension_name]
+        for prefix, resource_type in self.managed_prefixes.items():
+            if name.startswith(prefix):
+                return resource_type
+        return "other"
+
+    def tally(self, stats):
+        # Per resource type counts of what the plan does, into a RunStats
+        for action, names in (("create", self.create), ("update", self.update), ("delete", self.delete),
+                              ("unchanged", self.unchanged), ("skip", self.kept - set(self.desired))):
+            for name in names:
+                stats.tally(self.type_of(name), action)
+
+    def is_managed(self, alarm):
+        if any(alarm.name.startswith(p) for p in self.managed_prefixes):
+            return True
+        for dimension_name, values in (alarm.dimensions or {}).items():
+            for value in values:
+                prefix = self.managed.get((dimension_name, value))
+                if prefix and alarm.name.startswith(prefix):
+                    return True
+        return False
+
+    def compute(self):
+        desired  = set(self.desired)
+        existing = set(self.existing)
+        both     = desired & existing
+        self.create    = desired - existing
+        self.update    = set(n for n in both if alarm_settings(self.desired[n]) != alarm_settings(self.existing[n]))
+        self.unchanged = both - self.update
+        self.delete    = set(n for n in existing - desired - self.kept if self.is_managed(self.existing[n]))
+        return self
+
+    def changes(self, name):
+        old, new = alarm_settings(self.existing[name]), alarm_settings(self.desired[name])
+        return ', '.join("%s %s -> %s" % (k, old[k], new[k]) for k in sorted(new) if old[k] != new[k])
+
+    def report(self, title):
+        print("Plan for %s: %s to create, %s to update, %s to delete, %s unchanged" %
+              (title, len(self.create), len(self.update), len(self.delete), len(self.unchanged)))
+        for name in sorted(self.create):
+            print("  + %s" % name)
+        for name in sorted(self.update):
+            print("  ~ %s (%s)" % (name, self.changes(name)))
+        for name in sorted(self.delete):
+            print("  - %s" % name)
+        sys.stdout.flush()
+
+    def apply(self, executor):
+        # Composite alarms can only refer to alarms that exist, and an alarm
+        # can't be deleted while a composite refers to it, so: put the other
+        # alarms, then the composites, then delete composites, then the rest.
+        puts = sorted(self.create | self.update)
+        for composite in (False, True):
+            for name in puts:
+                if is_composite(self.desired[name]) != composite:
+                    continue
+                if name in self.create:
+                    description = "Creating alarm %s" % name
+                else:
+                    description = "Updating alarm %s (%s)" % (name, self.changes(name))
+                executor.submit(description, put_alarm, self.desired[name])
+            executor.wait()
+        deletes = sorted(self.delete)
+        for composite in (True, False):
+            # DeleteAlarms takes up to 100 names per call
+            for names in chunks([ n for n in deletes if is_composite(self.existing[n]) == composite ], 100):
+                executor.submit("Deleting alarms %s" % ', '.join(names), 'delete_alarms', names)
+            executor.wait()
+
+# The most metrics a metric-math alarm can have, counting its expression
+math_alarm_max_metrics = 10
+# The longest rule a composite alarm can have
+composite_rule_max_length = 10240
+
+def add_group_alarms(plan, profile_name, resource_policy, groups, sns_topic=None, exclude_alarm_names=[]):
+    # groups is (rule, tag value) -> [(resource id, metric, threshold)].
+    # Each group gets an alarm on e.g. MAX(METRICS()) of its members'
+    # metrics, split across several alarms if there are too many members.
+    per_alarm = math_alarm_max_metrics - 1
+    for (rule, group), members in groups.items():
+        members.sort(key=lambda m: m[0])
+        threshold = members[0][2]
+        if any(m[2] != threshold for m in members):
+            logging.warn("Members of %s have different %s thresholds; using %s's (%s)" %
+                         (group, rule.name, members[0][0], threshold))
+        for start in range(0, len(members), per_alarm):
+            name = rule.name
+            if start:
+                name = "%s-%s" % (rule.name, start // per_alarm + 1)
+            name = alarm_name(profile_name, resource_policy.prefix, 'group-%s' % group, name)
+            if any(p.search(name) for p in exclude_alarm_names):
+                logging.info("Not creating %s; excluded by policy." % name)
+                plan.keep(name)
+                continue
+            queries = [ { "id": "m%s" % (i + 1), "metric": metric.name, "namespace": metric.namespace,
+                          "dimensions": dict((k, list(v)) for k, v in metric.dimensions.items()),
+                          "statistic": rule.statistic, "period": rule.period, "return_data": False }
+                        for i, (resource_id, metric, _) in enumerate(members[start:start + per_alarm]) ]
+            queries.append({ "id": "e1", "expression": "%s(METRICS())" % rule.aggregate,
+                             "label": "%s %s of %s" % (rule.aggregate, rule.metric, group), "return_data": True })
+            plan.add(ManagedAlarm(name=name, metrics=queries, comparison=rule.comparison, threshold=threshold,
+                                  evaluation_periods=rule.evaluation_periods,
+                                  alarm_actions=[sns_topic] if sns_topic else [],
+                                  ok_actions=[sns_topic] if sns_topic else []))
+
+def add_composite_alarms(plan, profile_name, resource_policy, composites, sns_topic=None, exclude_alarm_names=[]):
+    # composites is composite key -> names of the alarms to roll up.  Only
+    # alarms that exist (or are about to) can go in the rule.
+    for key, children in composites.items():
+        children = sorted(set(n for n in children
+                              if n in plan.desired or (n in plan.kept and n in plan.existing)))
+        rules = []
+        for child in children:
+            term = 'ALARM("%s")' % child
+            if rules and len(rules[-1]) + len(term) + 4 <= composite_rule_max_length:
+                rules[-1] += ' OR ' + term
+            else:
+                rules.append(term)
+        for i, rule in enumerate(rules):
+            name = alarm_name(profile_name, resource_policy.prefix, 'composite-%s' % key,
+                              'Any' if not i else 'Any-%s' % (i + 1))
+            if any(p.search(name) for p in exclude_alarm_names):
+                logging.info("Not creating %s; excluded by policy." % name)
+                plan.keep(name)
+                continue
+            plan.add(ManagedAlarm(name=name, alarm_rule=rule,
+                                  alarm_actions=[sns_topic] if sns_topic else [],
+                                  ok_actions=[sns_topic] if sns_topic else []))
+
+# Inventory cache
+#
+# Runs every 15 minutes mostly see the same resources, metrics and alarms, so
+# they're kept in an SQLite file per (profile, region) and only re-fetched
+# once older than a per-kind TTL (see default_cache_ttls).
+
+default_cache_dir = os.path.expanduser('~/.cache/aws_manage_alarms')
+
+# Seconds each kind of data is trusted for.  EC2 and EBS are also topped up
+# with newly created resources on every run, so they can be kept longer.
+default_cache_ttls = { "ec2": 6 * 3600, "ebs": 6 * 3600, "elasticache": 3600, "rds": 3600, "elb": 3600,
+                       "metrics": 6 * 3600, "alarms": 3600 }
+
+class InventoryCache(object):
+    # Each kind of data ("ec2", "metrics:AWS/EC2", "alarms", ...) is a set of
+    # JSON records keyed by id, plus the time it was last fully refreshed.
+    def __init__(self, path, ttls=default_cache_ttls, refresh=False):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS records (kind TEXT, key TEXT, record TEXT, PRIMARY KEY (kind, key))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS refreshed (kind TEXT PRIMARY KEY, at REAL)")
+        self.ttls = ttls
+        # With refresh set everything is treated as stale, but still written back
+        self.refresh = refresh
+
+    def refreshed_at(self, kind):
+        row = self.db.execute("SELECT at FROM refreshed WHERE kind = ?", (kind,)).fetchone()
+        return row[0] if row else None
+
+    def fresh(self, kind):
+        at = self.refreshed_at(kind)
+        ttl = self.ttls.get(kind.split(':')[0], 0)
+        return not self.refresh and at is not None and time.time() - at < ttl
+
+    def mark(self, kind, at=None):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO refreshed (kind, at) VALUES (?, ?)", (kind, at or time.time()))
+
+    def expire(self, kind):
+        with self.db:
+            self.db.execute("DELETE FROM refreshed WHERE kind = ?", (kind,))
+
+    def load(self, kind):
+        return [ json.loads(r) for (r,) in self.db.execute("SELECT record FROM records WHERE kind = ?", (kind,)) ]
+
+    def keys(self, kind):
+        return set(k for (k,) in self.db.execute("SELECT key FROM records WHERE kind = ?", (kind,)))
+
+    def iterate(self, kind, batch_size=500):
+        # Like load(), but a batch at a time.  Pages by key rather than
+        # holding a cursor open, since committing resets open cursors.
+        key = ''
+        while True:
+            rows = self.db.execute("SELECT key, record FROM records WHERE kind = ? AND key > ? ORDER BY key LIMIT ?",
+                                   (kind, key, batch_size)).fetchall()
+            for key, record in rows:
+                yield json.loads(record)
+            if len(rows) < batch_size:
+                break
+
+    def clear(self, kind):
+        with self.db:
+            self.db.execute("DELETE FROM records WHERE kind = ?", (kind,))
+
+    def store(self, kind, items, replace=False):
+        # items are (key, record) pairs.  With replace, they're the complete
+        # set for this kind and count as a full refresh.
+        with self.db:
+            if replace:
+                self.db.execute("DELETE FROM records WHERE kind = ?", (kind,))
+                self.db.execute("INSERT OR REPLACE INTO refreshed (kind, at) VALUES (?, ?)", (kind, time.time()))
+            self.db.executemany("INSERT OR REPLACE INTO records (kind, key, record) VALUES (?, ?, ?)",
+                                [ (kind, key, json.dumps(record)) for key, record in items ])
+
+    def delete(self, kind, keys):
+        with self.db:
+            self.db.executemany("DELETE FROM records WHERE kind = ? AND key = ?", [ (kind, key) for key in keys ])
+
+def open_cache(profile_name, region, options):
+    if options.no_cache:
+        return None
+    if not os.path.isdir(options.cache_dir):
+        os.makedirs(options.cache_dir)
+    ttls = dict(default_cache_ttls)
+    for setting in options.cache_ttl:
+        kind, seconds = setting.split('=')
+        ttls[kind] = int(seconds)
+    return InventoryCache(os.path.join(options.cache_dir, '%s-%s.sqlite' % (profile_name, region)),
+                          ttls, refresh=options.refresh)
+
+def alarm_to_json(alarm):
+    record = alarm_settings(alarm)
+    record["name"] = alarm.name
+    record["state_value"] = alarm.state_value
+    return record
+
+def alarm_from_json(record):
+    alarm = ManagedAlarm(name=record["name"], metric=record["metric"], namespace=record["namespace"],
+                         statistic=record["statistic"], comparison=record["comparison"],
+                         threshold=record["threshold"], period=record["period"],
+                         evaluation_periods=record["evaluation_periods"], dimensions=record["dimensions"],
+                         alarm_actions=record["alarm_actions"], ok_actions=record["ok_actions"],
+                         metrics=record.get("metrics"), alarm_rule=record.get("alarm_rule"))
+    alarm.state_value = record["state_value"]
+    return alarm
+
+def get_cached_alarms(cloudwatch_connection, cache=None):
+    if cache is not None and cache.fresh("alarms"):
+        return dict((r["name"], alarm_from_json(r)) for r in cache.load("alarms"))
+    active_alarms = get_alarms(cloudwatch_connection)
+    if cache is not None:
+        cache.store("alarms", [ (name, alarm_to_json(a)) for name, a in active_alarms.items() ], replace=True)
     return active_alarms
 
-def apply_alarms(instance_id, cloudwatch_connection, instance_metrics,
-                 prefix='', comparison=">=", threshold=1, period=60, name="",
-                 evaluation_periods=5, statistic='Average', sns_topic=sns_topic, 
-                 dimension_name = 'InstanceId', active_alarms = [], force=False):
+def metric_to_json(metric):
+    return { "name": metric.name, "namespace": metric.namespace, "dimensions": dict(metric.dimensions) }
 
-    if isinstance(instance_metrics, str):
-        instance_metrics = [instance_metrics]
-    if isinstance(instance_id, str) or isinstance(instance_id, unicode):
-        instance_id = [instance_id]
+def metric_from_json(record):
+    metric = Metric()
+    metric.name = record["name"]
+    metric.namespace = record["namespace"]
+    metric.dimensions = record["dimensions"]
+    return metric
+
+def metric_key(metric):
+    return json.dumps([metric.name, sorted(metric.dimensions.items())])
+
+# Namespaces whose metrics get pre-fetched into the metric index.  System/Linux is
+# where the CloudWatch monitoring scripts put MemoryUtilization and
+# DiskSpaceUtilization.
+default_metric_namespaces = ['AWS/EC2', 'AWS/EBS', 'AWS/RDS', 'AWS/ElastiCache', 'AWS/ELB', 'System/Linux']
+
+def index_metric(metric_index, metric):
+    # Index under each of the metric's dimensions, both with and without the
+    # namespace.  Where several metrics share a dimension (e.g. ElastiCache
+    # publishes per-cluster and per-node series) keep the one with the fewest
+    # dimensions, since that's the one that describes the whole resource.
+    for dimension_name, dimension_values in metric.dimensions.items():
+        for dimension_value in dimension_values:
+            for namespace in [metric.namespace, None]:
+                key = (namespace, dimension_name, dimension_value, metric.name)
+                existing = metric_index.get(key)
+                if existing is None or len(metric.dimensions) < len(existing.dimensions):
+                    metric_index[key] = metric
+
+def list_all_metrics(cloudwatch_connection, **filters):
+    metrics = cloudwatch_connection.list_metrics(**filters)
+    all_metrics = list(metrics)
+    while metrics.next_token:
+        metrics = cloudwatch_connection.list_metrics(next_token=metrics.next_token, **filters)
+        all_metrics += list(metrics)
+    return all_metrics
+
+def get_metric_index(cloudwatch_connection, namespaces=default_metric_namespaces, cache=None):
+    # Calling list_metrics for every resource/metric pair costs several API
+    # calls per resource and gets throttled on big accounts.  Instead page
+    # through each namespace once and build a dict keyed by
+    # (namespace, dimension name, dimension value, metric name).
+    metric_index = {}
+    for namespace in namespaces:
+        kind = "metrics:%s" % namespace
+        if cache is not None and cache.fresh(kind):
+            metrics = [ metric_from_json(r) for r in cache.load(kind) ]
+        else:
+            metrics = list_all_metrics(cloudwatch_connection, namespace=namespace)
+            if cache is not None:
+                cache.store(kind, [ (metric_key(m), metric_to_json(m)) for m in metrics ], replace=True)
+        for metric in metrics:
+            index_metric(metric_index, metric)
+    logging.info("Indexed %s metrics across %s namespaces" % (len(metric_index), len(namespaces)))
+    return metric_index
+
+def index_resource_metrics(cloudwatch_connection, metric_index, dimension_name, resource_id, cache=None):
+    # A resource that's new since the metric index was cached won't be in it
+    # yet, so look its metrics up directly; one call per new resource.
+    metrics = list_all_metrics(cloudwatch_connection, dimensions={dimension_name:resource_id})
+    for metric in metrics:
+        index_metric(metric_index, metric)
+        if cache is not None:
+            cache.store("metrics:%s" % metric.namespace, [ (metric_key(metric), metric_to_json(metric)) ])
+    return metrics
+
+def get_awaiting_metrics(cache):
+    # Resources ("type:id" -> when) that hadn't reported any metrics when
+    # they were looked up directly.  They're looked up again every run until
+    # they have, or until the metrics TTL is up, by when the cached metric
+    # index has been rebuilt since and has them anyway.
+    if cache is None:
+        return {}
+    awaiting, expired = {}, []
+    for record in cache.load("awaiting_metrics"):
+        if time.time() - record["since"] < cache.ttls.get("metrics", 0):
+            awaiting[record["key"]] = record["since"]
+        else:
+            expired.append(record["key"])
+    cache.delete("awaiting_metrics", expired)
+    return awaiting
+
+def find_metric(cloudwatch_connection, dimension_name, dimension_value, metric_name,
+                metric_index=None, namespace=None):
+    # Without an index, fall back to asking CloudWatch directly.
+    if metric_index is None:
+        metric = cloudwatch_connection.list_metrics(dimensions={dimension_name:dimension_value},
+                                                    metric_name=metric_name, namespace=namespace)
+        if len(metric) > 0:
+            return metric[0]
+        return None
+    return metric_index.get((namespace, dimension_name, dimension_value, metric_name))
+
+def alarm_name(profile_name, prefix, instance_id, name):
+    # instance_id is either the id or [id, name]; alarms are named after the latter
+    if not isinstance(instance_id, basestring):
+        instance_id = instance_id[-1]
     if prefix:
         prefix = '%s-' % prefix
+    return "%s-%s%s-%s" % (profile_name, prefix, instance_id, name)
+
+def apply_alarms(instance_id, cloudwatch_connection, instance_metrics, plan,
+                 prefix='', comparison=">=", threshold=1, period=60, name="",
+                 evaluation_periods=5, statistic='Average', sns_topic=None,
+                 dimension_name = 'InstanceId', profile_name='default',
+                 metric_index=None, namespace=None, exclude_alarm_names=[]):
+    # Adds the alarms to the plan (see AlarmPlan), which makes the calls
 
-    if len(active_alarms) == 0:
-        active_alarms = get_alarms(cw)
+    if isinstance(instance_metrics, basestring):
+        instance_metrics = [instance_metrics]
+    if isinstance(instance_id, basestring):
+        instance_id = [instance_id]
 
     threshold = metric_human_readable(threshold)
 
     for instance_metric in instance_metrics:
         if not name:
             name = instance_metric
-        if len(instance_id) > 1:
-            instance_name = instance_id[1]
-            metric_name = "%s-%s%s-%s" % (profile_name,prefix,instance_name,name)
-            instance_id = instance_id[0]
-        else:
-            instance_id = instance_id[0]
-            metric_name = "%s-%s%s-%s" % (profile_name,prefix,instance_id,name)
-
-        if metric_name in active_alarms and not force:
-            logging.info("Metric %s is already configured" % metric_name)
-        elif "test" in metric_name.lower():
-            logging.info("Not creating %s; is a test box." % metric_name)
-        elif "Packer" in metric_name:
-            logging.info("Not creating %s; is a transient Packer box." % metric_name)
-        elif all(x in metric_name.lower() for x in ["ec2", "i-"]):
-            logging.info("EC2 instance %s is unnamed.  Not important enough to check." % metric_name)
-        else:
-            metric = cloudwatch_connection.list_metrics(dimensions={dimension_name:instance_id}, metric_name=instance_metric)
-            if len(metric) > 0:
-                logging.info("Active alarms %s" % len(active_alarms))
-                logging.warn("Creating metric for %s (%s): %s" % (instance_id,metric_name,metric[0]))
-                metric[0].create_alarm(name=metric_name,
-                                       comparison=comparison,
-                                       threshold=threshold,
-                                       period=period,
-                                       evaluation_periods=evaluation_periods,
-                                       statistic=statistic,
-                                       alarm_actions=[sns_topic],
-                                       ok_actions=[sns_topic])
-                time.sleep(0.5)
-
-def get_ebs_volumes(profile_name):
-    ec2 = boto.ec2.connect_to_region(region,profile_name=profile_name)
-    ebs_volumes = []
-    volumes = ec2.get_all_volumes()
-    for v in volumes:
-        ebs_volumes.append(v.id)
-    return ebs_volumes
-
-def weekly_cleanup_insufficients(cloudwatch_connection):
+        metric_name = alarm_name(profile_name, prefix, instance_id, name)
+        instance_id = instance_id[0]
+
+        if any(p.search(metric_name) for p in exclude_alarm_names):
+            logging.info("Not creating %s; excluded by policy." % metric_name)
+            plan.keep(metric_name)
+            continue
+        metric = find_metric(cloudwatch_connection, dimension_name, instance_id, instance_metric,
+                             metric_index=metric_index, namespace=namespace)
+        if metric is None:
+            logging.info("No %s metric for %s yet" % (instance_metric, instance_id))
+            plan.wait_for_metric(metric_name)
+            continue
+        plan.add(MetricAlarm(name=metric_name,
+                             metric=metric.name,
+                             namespace=metric.namespace,
+                             statistic=statistic,
+                             comparison=comparison,
+                             threshold=threshold,
+                             period=period,
+                             evaluation_periods=evaluation_periods,
+                             dimensions=metric.dimensions,
+                             alarm_actions=[sns_topic] if sns_topic else [],
+                             ok_actions=[sns_topic] if sns_topic else []))
+
+def get_ebs_volumes(profile_name, region, filters=None, resource_id=None):
+    # boto's get_all_volumes doesn't paginate, so make the DescribeVolumes
+    # call ourselves
+    ec2 = connect('ec2', region, profile_name)
+    if resource_id:
+        filters = { 'volume-id': [resource_id] }
+    params = { 'MaxResults': 500 }
+    if filters:
+        ec2.build_filter_params(params, filters)
+    while True:
+        volumes = ec2.get_list('DescribeVolumes', params, [('item', Volume)], verb='POST')
+        for v in volumes:
+            yield Resource(v.id, tags=dict(v.tags))
+        if not volumes.next_token:
+            break
+        params['NextToken'] = volumes.next_token
+
+resource_getters = { "ec2": get_ec2_instances, "ebs": get_ebs_volumes, "elasticache": get_elasticache_instances,
+                     "rds": get_rds_instances, "elb": get_elb_instances }
+
+# What describing a resource by id that doesn't exist gives (EC2 and EBS
+# just return nothing)
+not_found_errors = ['CacheClusterNotFound', 'DBInstanceNotFound', 'LoadBalancerNotFound']
+# EC2 instances in these states are as good as gone
+gone_instance_states = ['shutting-down', 'terminated']
+
+def find_resource(resource_type, profile_name, region, resource_id):
+    # The resource with this id, or None if there isn't one
+    try:
+        for resource in resource_getters[resource_type](profile_name, region, resource_id=resource_id):
+            if resource.id == resource_id:
+                return resource
+    except BotoServerError as e:
+        if e.error_code not in not_found_errors:
+            raise
+    return None
+
+def describe_resource(resource_type, resource):
+    # Returns what the policy needs to know about a resource: its id, the id
+    # (or [id, name]) apply_alarms names its alarms after, the name and tags
+    # the include/exclude patterns match against, and the variables threshold
+    # expressions can use.
+    variables = {}
+    if resource_type == "ec2":
+        alarm_id = resource.id
+        if resource.name:
+            alarm_id = [ resource.id, resource.name ]
+        stats = instance_stats(resource.instance_class)
+        if stats:
+            variables = { "cpu": stats.cpu, "cph": stats.cph, "ram": stats.ram }
+        return resource.id, alarm_id, resource.name or resource.id, resource.tags, variables
+    if resource_type == "rds":
+        stats = instance_stats(resource.instance_class)
+        variables = { "allocated_storage": resource.allocated_storage }
+        if stats:
+            variables.update({ "cpu": stats.cpu, "cph": stats.cph, "ram": stats.ram })
+    return resource.id, resource.id, resource.id, resource.tags, variables
+
+def created_since_filters(resource_type, since):
+    # EC2 can't filter on a time range, but launch-time/create-time take
+    # wildcards, so ask for everything created on each (UTC) day since then
+    days = []
+    day = datetime.datetime.utcfromtimestamp(since).date()
+    while day <= datetime.datetime.utcnow().date():
+        days.append('%s*' % day.isoformat())
+        day += datetime.timedelta(days=1)
+    return { incremental_filters[resource_type]: days }
+
+# Resource types that can be refreshed incrementally, and the filter for it
+incremental_filters = { "ec2": "launch-time", "ebs": "create-time" }
+
+def get_resources(resource_type, profile_name, region, cache=None):
+    # Yields (resource, is_new) for every resource of one type, is_new being
+    # whether it wasn't in the cache before.  Within the type's TTL the cached
+    # inventory is used, topped up with anything launched since the last run
+    # where the API can filter on that.  Resources deleted in the meantime
+    # drop out at the next full refresh.
+    getter = resource_getters[resource_type]
+    if cache is None:
+        for resource in prefetch(getter(profile_name, region)):
+            yield resource, False
+        return
+
+    previous = cache.keys(resource_type)
+    if cache.fresh(resource_type):
+        seen = set()
+        if resource_type in incremental_filters:
+            since = cache.refreshed_at(resource_type + ':incremental') or cache.refreshed_at(resource_type)
+            started = time.time()
+            new = list(getter(profile_name, region, filters=created_since_filters(resource_type, since)))
+            cache.store(resource_type, [ (r.id, r.to_json()) for r in new ])
+            cache.mark(resource_type + ':incremental', started)
+            for resource in new:
+                seen.add(resource.id)
+                yield resource, resource.id not in previous
+        for record in cache.iterate(resource_type):
+            if record['id'] not in seen:
+                yield Resource.from_json(record), False
+    else:
+        # Expire the cached copy until we've got all of it again, so a run
+        # that dies half way through doesn't leave a partial inventory
+        # looking fresh
+        cache.expire(resource_type)
+        cache.clear(resource_type)
+        for batch in batches(prefetch(getter(profile_name, region)), 500):
+            cache.store(resource_type, [ (r.id, r.to_json()) for r in batch ])
+            for resource in batch:
+                yield resource, bool(previous) and resource.id not in previous
+        cache.mark(resource_type)
+
+# The dimension each resource type's alarms are keyed on
+resource_dimensions = { "ec2": "InstanceId", "ebs": "VolumeId", "elasticache": "CacheClusterId",
+                        "rds": "DBInstanceIdentifier", "elb": "LoadBalancerName" }
+dimension_types = dict((d, t) for t, d in resource_dimensions.items())
+
+def cleanup_due(options):
+    # Cleanup runs when asked for with --cleanup, or otherwise during the
+    # 8AM hour on Monday
+    now = datetime.datetime.today()
+    return options.cleanup or (now.weekday() == 0 and now.hour == 8)
+
+def get_insufficient_alarms(cloudwatch_connection):
+    # Only ask for the alarms in INSUFFICIENT_DATA rather than filtering them here
+    return list(describe_alarms(cloudwatch_connection, state_value="INSUFFICIENT_DATA"))
+
+def cleanup_insufficients(cloudwatch_connection, executor, inventory, dry_run=False):
     # When a server gets deleted, the alarms will show up as INSUFFICIENT_DATA
-    # from then on.  This can happen normally as well, but it's usually
-    # transient.  This function deletes all alarms in that state, trusting
-    # that subsequent runs will add them back in.
-    day = datetime.datetime.today().weekday()
-    hour = datetime.datetime.today().hour
-    if day == 0 and hour == 8:
-        alarm_obj = cloudwatch_connection.describe_alarms()
-        #insufficient_alarms = []
-        while alarm_obj.next_token:
-            alarm_obj = cloudwatch_connection.describe_alarms(next_token=alarm_obj.next_token)
-            for a in alarm_obj:
-                if a.state_value == "INSUFFICIENT_DATA":
-                    logging.warn("Deleting alarm %s which is no longer reporting back." % a.name)
-                    a.delete()
-                    # Forgot there's a rate limit issue
-                    time.sleep(0.5)
+    # from then on.  This can happen normally as well, so only alarms on a
+    # resource that's missing from the inventory (dimension name -> set of
+    # live ids) get deleted; anything we can't tie to a resource we took
+    # inventory of is left alone.
+    orphans = []
+    for a in get_insufficient_alarms(cloudwatch_connection):
+        for dimension_name, values in (a.dimensions or {}).items():
+            if dimension_name in inventory and not any(v in inventory[dimension_name] for v in values):
+                orphans.append(a.name)
+                run_stats.tally(dimension_types.get(dimension_name, "other"), "cleanup")
+                break
+    if dry_run:
+        for name in orphans:
+            print("Would delete alarm %s whose resource is gone." % name)
+    else:
+        # DeleteAlarms takes up to 100 names per call
+        for names in chunks(orphans, 100):
+            executor.submit("Deleting %s alarms whose resources are gone: %s" % (len(names), ', '.join(names)),
+                            'delete_alarms', names)
+    return orphans
 
-if __name__ == '__main__':
-    cw  = boto.ec2.cloudwatch.connect_to_region(region,profile_name=profile_name)
+def plan_resource(cw, resource_policy, resource_id, alarm_id, name, tags, variables, groups, composites, apply_args):
+    # Add one resource's alarms to the plan (in apply_args), per the policy.
+    # Its group_by members go in groups and its composite_by children in
+    # composites, for add_group_alarms/add_composite_alarms.
+    plan, profile_name = apply_args["plan"], apply_args["profile_name"]
+    if not resource_policy.matches(name, tags):
+        logging.info("Not creating alarms for %s %s; excluded by policy." % (resource_policy.resource_type, name))
+        return
+    plan.manage(resource_policy.dimension_name, resource_id,
+                alarm_name(profile_name, resource_policy.prefix, alarm_id, ''))
+    composite_key = resource_policy.composite_key(alarm_id, tags)
+    for rule in resource_policy.rules:
+        try:
+            threshold = rule.threshold_for(name, variables)
+        except ThresholdError as e:
+            logging.warn("Leaving %s alone; %s" % (alarm_name(profile_name, resource_policy.prefix, alarm_id, rule.name), e))
+            plan.keep(alarm_name(profile_name, resource_policy.prefix, alarm_id, rule.name))
+            continue
+        if threshold is None:
+            continue
+        if rule.group_by and tags.get(rule.group_by):
+            metric = find_metric(cw, resource_policy.dimension_name, resource_id, rule.metric,
+                                 metric_index=apply_args["metric_index"], namespace=rule.namespace)
+            if metric is not None:
+                groups.setdefault((rule, tags[rule.group_by]), []).append((resource_id, metric, threshold))
+            continue
+        if composite_key:
+            # Only the composite alarm notifies
+            composites.setdefault(composite_key, []).append(
+                alarm_name(profile_name, resource_policy.prefix, alarm_id, rule.name))
+        apply_alarms(alarm_id, cw, rule.metric, name=rule.name, prefix=resource_policy.prefix,
+                     dimension_name=resource_policy.dimension_name, namespace=rule.namespace,
+                     comparison=rule.comparison, threshold=threshold, period=rule.period,
+                     evaluation_periods=rule.evaluation_periods, statistic=rule.statistic,
+                     **dict(apply_args, sns_topic=None if composite_key else apply_args["sns_topic"]))
+
+def manage_alarms(profile_name, region, sns_topic, options):
+    # Reconcile the alarms for one (profile, region)
+    global run_stats
+    run_stats = RunStats()
+    run_stats.phase("setup")
+    started = time.time()
+    policy = CompiledPolicy(options.policy, profile_name)
+    cw  = connect('cloudwatch', region, profile_name)
+    executor = MutationExecutor(lambda: connect('cloudwatch', region, profile_name),
+                                workers=options.workers, rate=options.mutation_rate, max_rate=options.max_mutation_rate)
 
-    # This only runs during the 8AM hour on Monday
-    weekly_cleanup_insufficients(cw)
+    cache = open_cache(profile_name, region, options)
 
-    active_alarms = get_alarms(cw)
+    run_stats.phase("alarms")
+    active_alarms = get_cached_alarms(cw, cache)
     logging.warn("Got %s alarms already configured." % len(active_alarms))
 
-    # EC2 Instances
-    # Note: DiskSpaceUtilization is a custom metric; you'd need to roll your own to get that.
-    ec2_args = { "prefix": "ec2", "active_alarms": active_alarms }
-    for instance_id in get_ec2_instances(profile_name):
-        nCPU = instance_stats(instance_id.instance_type).cpu
-        cpu_credit_rate = instance_stats(instance_id.instance_type).cph
-        inst_name = instance_id.nametag
-        if instance_id.name:
-            inst_name = [ instance_id.id, instance_id.name ]
-        apply_alarms(inst_name, cw, "CPUCreditBalance", comparison="<=", threshold=10 * cpu_credit_rate, **ec2_args)
-        apply_alarms(inst_name, cw, "StatusCheckFailed", **ec2_args)
-        apply_alarms(inst_name, cw, "MemoryUtilization", threshold=80, **ec2_args)
-        apply_alarms(inst_name, cw, "CPUUtilization", threshold=90 * nCPU, **ec2_args)
-        apply_alarms(inst_name, cw, "DiskSpaceUtilization", threshold=50, **ec2_args)
-    
-    # Elasticache
-    # EC2 local disk - EBS Volumes
-    ebs_args = { "prefix": "ebs", "active_alarms": active_alarms, "dimension_name": "VolumeId" }
-    for vol in get_ebs_volumes(profile_name):
-        apply_alarms(vol, cw, "BurstBalance", comparison="<=", threshold=60, period=300, **ebs_args)
-
-    ec_args = { "prefix" : "elasticache", "active_alarms" : active_alarms, "dimension_name": "CacheClusterId" }
-    for cluster_instance in get_elasticache_instances(profile_name):
-        # I was getting alarms in swap usage when we weren't pegged for memory.  BytesUsedForCache is a better check
-        #apply_alarms(cluster_instance.nametag, cw, "SwapUsage", threshold='100mb', comparison=">=", **ec_args)
-        apply_alarms(cluster_instance.nametag, cw, "BytesUsedForCache", threshold='300mb', comparison=">=", **ec_args)
-        apply_alarms(cluster_instance.nametag, cw, "Evictions", threshold='20', comparison=">=", **ec_args)
-        apply_alarms(cluster_instance.nametag, cw, "CurrConnections", threshold='250', comparison=">=", **ec_args)
-        apply_alarms(cluster_instance.nametag, cw, "FreeableMemory", threshold='1gb', comparison="<=", **ec_args)
-    
-    # RDS
-    rds_args = { "prefix": "rds", "dimension_name": "DBInstanceIdentifier", "active_alarms": active_alarms }
-    for db_instance in get_rds_instances(profile_name):
-        apply_alarms(db_instance.nametag, cw, "SwapUsage", threshold='1gb', **rds_args)
-        apply_alarms(db_instance.nametag, cw, "CPUUtilization", threshold=80, **rds_args)
-        if instance_stats(db_instance.instance_class).cph:
-            apply_alarms(db_instance.nametag, cw, "CPUCreditBalance", comparison="<=", threshold=50, **rds_args)
-        if db_instance.allocated_storage > 0:
-            twenty_percent = int(db_instance.allocated_storage * 0.2)
-            ten_percent = int(db_instance.allocated_storage * 0.1)
-            apply_alarms(db_instance.nametag, cw, "FreeStorageSpace", comparison="<=", threshold='%dgb' % ten_percent, **rds_args)
+    run_stats.phase("metric_index")
+    metric_index = get_metric_index(cw, default_metric_namespaces + options.metric_namespace, cache)
+
+    awaiting = get_awaiting_metrics(cache)
+
+    plan = AlarmPlan(active_alarms)
+    apply_args = { "metric_index": metric_index, "plan": plan, "profile_name": profile_name,
+                   "sns_topic": sns_topic, "exclude_alarm_names": policy.exclude_alarm_names }
+    # Live resource ids, by dimension name, for the cleanup
+    inventory = {}
+    for resource_policy in policy.resource_types:
+        run_stats.phase("evaluate:%s" % resource_policy.resource_type)
+        plan.resource_type = resource_policy.resource_type
+        live_ids = inventory.setdefault(resource_dimensions[resource_policy.resource_type], set())
+        # (rule, tag value) -> members, for group_by rules; composite key ->
+        # alarm names, when the type has composite_by
+        groups = {}
+        composites = {}
+        for resource, is_new in get_resources(resource_policy.resource_type, profile_name, region, cache):
+            resource_id, alarm_id, name, tags, variables = describe_resource(resource_policy.resource_type, resource)
+            # Terminated instances are still listed for a while; their alarms
+            # go, as in --events mode
+            if resource.state in gone_instance_states:
+                plan.manage(resource_policy.dimension_name, resource_id,
+                            alarm_name(profile_name, resource_policy.prefix, alarm_id, ''))
+                continue
+            live_ids.add(resource_id)
+            key = '%s:%s' % (resource_policy.resource_type, resource_id)
+            if is_new or key in awaiting:
+                metrics = index_resource_metrics(cw, metric_index, resource_policy.dimension_name, resource_id, cache)
+                if metrics:
+                    cache.delete("awaiting_metrics", [key])
+                elif key not in awaiting:
+                    cache.store("awaiting_metrics", [ (key, { "key": key, "since": time.time() }) ])
+            plan_resource(cw, resource_policy, resource_id, alarm_id, name, tags, variables, groups, composites,
+                          apply_args)
+
+        plan.manage_prefix(alarm_name(profile_name, resource_policy.prefix, 'group', ''))
+        plan.manage_prefix(alarm_name(profile_name, resource_policy.prefix, 'composite', ''))
+        add_group_alarms(plan, profile_name, resource_policy, groups, sns_topic, policy.exclude_alarm_names)
+        add_composite_alarms(plan, profile_name, resource_policy, composites, sns_topic, policy.exclude_alarm_names)
+
+    run_stats.phase("plan")
+    plan.compute()
+    plan.tally(run_stats)
+    if options.plan:
+        plan.report("%s/%s" % (profile_name, region))
+    else:
+        logging.warn("%s alarms to create, %s to update, %s to delete, %s unchanged." %
+                     (len(plan.create), len(plan.update), len(plan.delete), len(plan.unchanged)))
+        run_stats.phase("apply")
+        plan.apply(executor)
+
+    orphans = []
+    if cleanup_due(options):
+        run_stats.phase("cleanup")
+        # Alarms are deleted for want of their resource, so the inventory has
+        # to be live.  A cached one can be missing anything created since
+        # (only EC2 and EBS get topped up), so unless a type was listed in
+        # full during this run, list it now.
+        for resource_type, dimension_name in resource_dimensions.items():
+            listed = cache is None or (cache.refreshed_at(resource_type) or 0) >= started
+            if dimension_name not in inventory or not listed:
+                inventory[dimension_name] = set(r.id for r in prefetch(resource_getters[resource_type](profile_name, region))
+                                                if r.state not in gone_instance_states)
+        orphans = cleanup_insufficients(cw, executor, inventory, dry_run=options.plan)
+
+    # Waiting for the alarm writes still queued
+    run_stats.phase("mutations")
+    summary = executor.join()
+    run_stats.phase("cache")
+    if cache is not None and not options.plan:
+        # Keep the cached alarms in step with what we just did, unless some
+        # calls failed and we can't be sure what state things are in
+        if summary["failed"]:
+            cache.expire("alarms")
         else:
-            # I don't have an easy way to calculate this; it's based on instance size, and a t2.small regularly has 25GB free
-            apply_alarms(db_instance.nametag, cw, "FreeLocalStorage", comparison="<=", threshold='15gb', **rds_args)
-        apply_alarms(db_instance.nametag, cw, "EngineUptime", comparison="<=", threshold='50000', **rds_args)
+            cache.store("alarms", [ (name, alarm_to_json(plan.desired[name])) for name in plan.create | plan.update ])
+            cache.delete("alarms", list(plan.delete) + orphans)
+    summary.update({ "created": len(plan.create), "updated": len(plan.update),
+                     "deleted": len(plan.delete) + len(orphans), "unchanged": len(plan.unchanged),
+                     "report": run_stats.report() })
+    return summary
 
-        available_memory_gb = instance_stats(db_instance.instance_class).ram
-        # 90% of the aws calculation for default connection maximum
-        threshold = ((available_memory_gb * 1024 * 1024 * 1024) / 12582880) * 0.9
-        apply_alarms(db_instance.nametag, cw, "DatabaseConnections", threshold=threshold, **rds_args)
-        # Investigate: FreeableMemory
+# Event-driven mode
+#
+# With --events, rather than sweeping every resource, the script reads
+# resource lifecycle events and reconciles just the resources they name,
+# with the same policy and rules as a full run.  Events are EventBridge
+# notifications (EC2 instance state changes, RDS instance events, ... are
+# recognised by the ARNs in their "resources") or CloudTrail records of the
+# calls that create and delete resources, either as EventBridge delivers
+# them or raw.  They come from an SQS queue an EventBridge rule targets, or
+# as JSON lines in a file or on stdin.  Whatever an event says happened,
+# the resource is described again, so late or out-of-order events can't
+# leave the wrong alarms behind.
+
+# Resource ARNs -> resource type, the id being the first group
+resource_arns = [ (re.compile(r'^arn:aws[\w-]*:ec2:[^:]*:[^:]*:instance/(.+)$'), "ec2"),
+                  (re.compile(r'^arn:aws[\w-]*:ec2:[^:]*:[^:]*:volume/(.+)$'), "ebs"),
+                  (re.compile(r'^arn:aws[\w-]*:elasticache:[^:]*:[^:]*:cluster:(.+)$'), "elasticache"),
+                  (re.compile(r'^arn:aws[\w-]*:rds:[^:]*:[^:]*:db:(.+)$'), "rds"),
+                  (re.compile(r'^arn:aws[\w-]*:elasticloadbalancing:[^:]*:[^:]*:loadbalancer/([^/]+)$'), "elb") ]
+
+# CloudTrail eventName -> resource type and where the ids are in the record
+cloudtrail_events = {
+    "RunInstances":       ("ec2", "responseElements.instancesSet.items.instanceId"),
+    "TerminateInstances": ("ec2", "requestParameters.instancesSet.items.instanceId"),
+    "CreateVolume":       ("ebs", "responseElements.volumeId"),
+    "DeleteVolume":       ("ebs", "requestParameters.volumeId"),
+    "CreateCacheCluster": ("elasticache", "requestParameters.cacheClusterId"),
+    "DeleteCacheCluster": ("elasticache", "requestParameters.cacheClusterId"),
+    "CreateDBInstance":   ("rds", "requestParameters.dBInstanceIdentifier"),
+    "DeleteDBInstance":   ("rds", "requestParameters.dBInstanceIdentifier"),
+    # Only classic load balancers have a loadBalancerName
+    "CreateLoadBalancer": ("elb", "requestParameters.loadBalancerName"),
+    "DeleteLoadBalancer": ("elb", "requestParameters.loadBalancerName"),
+}
+# Tagging can rename an instance's alarms or change whether the policy
+# covers it; the type is told by the id
+tag_events = ['CreateTags', 'DeleteTags']
+tagged_id_prefixes = { "i-": "ec2", "vol-": "ebs" }
+# ElastiCache and RDS ids are lowercased whatever case they were created in
+lowercase_id_types = ['elasticache', 'rds']
+
+def record_values(record, path):
+    # The values at a dotted path in a record, going through any lists on the way
+    values = [record]
+    for key in path.split('.'):
+        values = [ v.get(key) for v in values if isinstance(v, dict) ]
+        values = [ x for v in values for x in (v if isinstance(v, list) else [v]) if x is not None ]
+    return values
+
+def event_resources(event):
+    # Yields (region, resource type, resource id) for each resource an event
+    # names.  SNS notifications and CloudTrail log files (a list of
+    # "Records") are unwrapped.
+    if event.get('Type') == 'Notification' and 'Message' in event:
+        for named in event_resources(parse_event(event['Message'])):
+            yield named
+        return
+    if 'Records' in event:
+        for record in event['Records']:
+            for named in event_resources(record):
+                yield named
+        return
+    if event.get('detail-type') == 'AWS API Call via CloudTrail':
+        for named in event_resources(dict(event['detail'], awsRegion=event['detail'].get('awsRegion', event.get('region')))):
+            yield named
+        return
+    resources = []
+    if 'eventName' in event:
+        # A CloudTrail record; calls that failed didn't change anything
+        if event.get('errorCode'):
+            return
+        if event['eventName'] in cloudtrail_events:
+            resource_type, path = cloudtrail_events[event['eventName']]
+            resources = [ (resource_type, i) for i in record_values(event, path) ]
+        elif event['eventName'] in tag_events:
+            for resource_id in record_values(event, 'requestParameters.resourcesSet.items.resourceId'):
+                resources += [ (t, resource_id) for p, t in tagged_id_prefixes.items() if resource_id.startswith(p) ]
+        region = event.get('awsRegion')
+    else:
+        for arn in event.get('resources') or []:
+            for pattern, resource_type in resource_arns:
+                match = pattern.match(arn)
+                if match:
+                    resources.append((resource_type, match.group(1)))
+        region = event.get('region')
+    for resource_type, resource_id in resources:
+        if resource_type in lowercase_id_types:
+            resource_id = resource_id.lower()
+        yield region, resource_type, str(resource_id)
+
+def parse_event(text):
+    try:
+        event = json.loads(text)
+    except ValueError as e:
+        logging.error("Ignoring event that isn't JSON (%s): %s" % (e, text[:200]))
+        return {}
+    if not isinstance(event, dict):
+        logging.error("Ignoring event that isn't a JSON object: %s" % text[:200])
+        return {}
+    return event
+
+class LineEvents(object):
+    # JSON lines from a file, or stdin for "-".  Each line is a batch of
+    # its own, so events piped in are handled as they're written.  There's
+    # no retrying; the next full run catches anything missed.
+    retries = False
+
+    def __init__(self, path):
+        self.infile = sys.stdin if path == '-' else open(path)
+
+    def batches(self):
+        # readline, since iterating over a pipe reads ahead
+        for line in iter(self.infile.readline, ''):
+            if line.strip():
+                yield [ (parse_event(line), line) ]
+
+    def acknowledge(self, messages):
+        pass
+
+class QueueEvents(object):
+    # Messages from an SQS queue, given by its URL, long-polled ten at a
+    # time.  A message is deleted once its resources are done with; until
+    # then it's received again after the queue's visibility timeout.
+    retries = True
+
+    def __init__(self, url, region, profile_name):
+        # https://sqs.<region>.amazonaws.com/<account>/<queue name>
+        host, account, name = url.rstrip('/').split('/')[-3:]
+        if host.startswith('sqs.') and host.count('.') > 2:
+            region = host.split('.')[1]
+        self.sqs = connect('sqs', region, profile_name)
+        self.queue = self.sqs.get_queue(name, owner_acct_id=account)
+        if self.queue is None:
+            raise ValueError("No such SQS queue: %s" % url)
+        # EventBridge sends plain JSON, not boto's base64
+        self.queue.set_message_class(RawMessage)
+
+    def batches(self):
+        while True:
+            try:
+                messages = self.sqs.receive_message(self.queue, number_messages=10, wait_time_seconds=20,
+                                                    attributes='SentTimestamp')
+            except BotoServerError as e:
+                logging.warn("Couldn't receive from %s (%s); trying again" % (self.queue.url, e))
+                time.sleep(5)
+                continue
+            if messages:
+                yield [ (parse_event(m.get_body()), m) for m in messages ]
 
-    # ELB
-    elb_args = { "prefix": "elb", "dimension_name": "LoadBalancerName", "active_alarms": active_alarms, "evaluation_periods": 2 }
-    for elb_instance in get_elb_instances(profile_name):
-        if "AppELBTes" not in elb_instance.nametag and "gonefishing" not in elb_instance.nametag:
-            apply_alarms(elb_instance.nametag, cw, "UnHealthyHostCount", statistic='Minimum', comparison=">=", **elb_args)
-            apply_alarms(elb_instance.nametag, cw, "HealthyHostCount", statistic='Maximum', comparison="<", threshold=2, **elb_args)
-            apply_alarms(elb_instance.nametag, cw, "HTTPCode_Backend_5XX", statistic='SampleCount', comparison=">", threshold=100, **elb_args)
+    def sent_at(self, message):
+        return int(message.attributes['SentTimestamp']) / 1000.0
 
-    logging.warn("No other alarms to create.")
+    def acknowledge(self, messages):
+        # DeleteMessageBatch takes up to 10
+        for batch in chunks(messages, 10):
+            self.sqs.delete_message_batch(self.queue, batch)
 
+def open_events(source, region, profile_name):
+    if source.startswith('https://'):
+        return QueueEvents(source, region, profile_name)
+    return LineEvents(source)
 
+class EventReconciler(object):
+    # Reconciles the alarms of individual resources for one (profile,
+    # region), keeping the policy, connections, cache and write pool between
+    # batches.  Each resource costs a describe, a DescribeAlarms for its
+    # alarm name prefix, a ListMetrics and its writes, however big the fleet.
+    # Group and composite alarms are left to the next full run, which
+    # recomputes their members; resources of a composite_by type get their
+    # (silent) per-resource alarms, but none are deleted, since composites
+    # may still refer to them.
+    def __init__(self, profile_name, region, sns_topic, options):
+        self.profile_name = profile_name
+        self.region = region
+        self.sns_topic = sns_topic
+        self.options = options
+        self.policy = CompiledPolicy(options.policy, profile_name)
+        self.resource_policies = dict((p.resource_type, p) for p in self.policy.resource_types)
+        self.cw = connect('cloudwatch', region, profile_name)
+        self.executor = MutationExecutor(lambda: connect('cloudwatch', region, profile_name), workers=options.workers,
+                                         rate=options.mutation_rate, max_rate=options.max_mutation_rate)
+        self.cache = open_cache(profile_name, region, options)
+        self.counts = { "events": 0, "resources": 0, "created": 0, "updated": 0, "deleted": 0, "unchanged": 0,
+                        "errors": 0 }
+
+    def reconcile(self, resources):
+        # resources is a set of (resource type, id).  Returns the ones that
+        # need another go: they haven't reported metrics yet, or writes failed.
+        plan = AlarmPlan({})
+        metric_index = {}
+        apply_args = { "metric_index": metric_index, "plan": plan, "profile_name": self.profile_name,
+                       "sns_topic": self.sns_topic, "exclude_alarm_names": self.policy.exclude_alarm_names }
+        waiting = set()
+        for resource_type, resource_id in sorted(resources):
+            resource_policy = self.resource_policies.get(resource_type)
+            if resource_policy is None:
+                continue
+            run_stats.phase("describe")
+            resource = find_resource(resource_type, self.profile_name, self.region, resource_id)
+            if resource is not None:
+                resource_id, alarm_id, name, tags, variables = describe_resource(resource_type, resource)
+            else:
+                alarm_id = resource_id
+            name_prefix = alarm_name(self.profile_name, resource_policy.prefix, alarm_id, '')
+            run_stats.phase("alarms")
+            plan.existing.update((a.name, a) for a in describe_alarms(self.cw, name_prefix=name_prefix))
+            plan.resource_type = resource_type
+            self.counts["resources"] += 1
+
+            if resource is None or resource.state in gone_instance_states:
+                if resource_policy.composite_by:
+                    logging.info("Leaving the alarms of %s %s to the cleanup; composite alarms may refer to them" %
+                                 (resource_type, resource_id))
+                    continue
+                logging.info("%s %s is gone" % (resource_type, resource_id))
+                plan.manage(resource_policy.dimension_name, resource_id, name_prefix)
+                if self.cache is not None and not self.options.plan:
+                    self.cache.delete(resource_type, [resource_id])
+                continue
+
+            run_stats.phase("metric_index")
+            metrics = index_resource_metrics(self.cw, metric_index, resource_policy.dimension_name, resource_id,
+                                             self.cache)
+            run_stats.phase("evaluate:%s" % resource_type)
+            waited = len(plan.waiting)
+            plan_resource(self.cw, resource_policy, resource_id, alarm_id, name, tags, variables, {}, {}, apply_args)
+            # Only a resource that hasn't reported any metrics yet is worth
+            # waiting on; some (custom) metrics may never turn up
+            if not metrics and len(plan.waiting) > waited:
+                waiting.add((resource_type, resource_id))
+            if self.cache is not None and not self.options.plan:
+                self.cache.store(resource_type, [ (resource.id, resource.to_json()) ])
+
+        run_stats.phase("plan")
+        plan.compute()
+        plan.tally(run_stats)
+        for key, names in (("created", plan.create), ("updated", plan.update), ("deleted", plan.delete),
+                           ("unchanged", plan.unchanged)):
+            self.counts[key] += len(names)
+        if self.options.plan:
+            plan.report("%s/%s" % (self.profile_name, self.region))
+            return waiting
+        run_stats.phase("apply")
+        failed = self.executor.failed
+        plan.apply(self.executor)
+        run_stats.phase(None)
+        if self.executor.failed > failed:
+            if self.cache is not None:
+                self.cache.expire("alarms")
+            return set(resources)
+        if self.cache is not None:
+            self.cache.store("alarms", [ (n, alarm_to_json(plan.desired[n])) for n in plan.create | plan.update ])
+            self.cache.delete("alarms", list(plan.delete))
+        return waiting
+
+    def summary(self):
+        # In the shape manage_alarms() returns
+        summary = dict(self.counts, completed=self.executor.completed, failed=self.executor.failed,
+                       throttled=self.executor.throttled)
+        summary["report"] = run_stats.report()
+        return summary
+
+def manage_events(profile_name, region, sns_topic, options):
+    # The --events loop: reconcile the resources each batch of events names,
+    # until the events run out (or, for a queue, we're interrupted)
+    global run_stats
+    run_stats = RunStats()
+    started = time.time()
+    reconciler = EventReconciler(profile_name, region, sns_topic, options)
+    events = open_events(options.events, region, profile_name)
+    try:
+        for batch in events.batches():
+            named = []
+            for event, message in batch:
+                resources = set()
+                for event_region, resource_type, resource_id in event_resources(event):
+                    if event_region and event_region != region:
+                        logging.info("Ignoring %s %s in %s" % (resource_type, resource_id, event_region))
+                    else:
+                        resources.add((resource_type, resource_id))
+                named.append(resources)
+            reconciler.counts["events"] += len(batch)
+            # One batch failing (a throttled describe, say) mustn't stop the
+            # loop.  Its messages aren't acknowledged, so a queue delivers
+            # them again; events from a file are left to the next full run.
+            try:
+                retry = reconciler.reconcile(set().union(*named))
+
+                done = []
+                for (event, message), resources in zip(batch, named):
+                    pending = resources & retry
+                    if pending and events.retries and events.sent_at(message) > time.time() - options.metric_wait:
+                        logging.info("Will retry %s" % ', '.join('%s %s' % r for r in sorted(pending)))
+                        continue
+                    for resource_type, resource_id in sorted(pending):
+                        logging.warn("Gave up waiting on %s %s; the next full run will pick it up" %
+                                     (resource_type, resource_id))
+                    done.append(message)
+                if not options.plan:
+                    events.acknowledge(done)
+            except Exception:
+                reconciler.counts["errors"] += 1
+                logging.exception("Failed to handle %s events%s" %
+                                  (len(batch), "; they'll be delivered again" if events.retries else ""))
+            write_run_reports([ dict(reconciler.summary(), error=None, profile_name=profile_name, region=region,
+                                     started=started, wall_time=time.time() - started) ], options)
+    except KeyboardInterrupt:
+        pass
+    reconciler.executor.join()
+    return reconciler.summary()
+
+def run_target(target):
+    # Worker entry point for fan-out mode.  Never raises, so one broken
+    # account doesn't take the rest of the run down with it.
+    profile_name, region, sns_topic, options = target
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter('%s/%s %%(levelname)s:%%(message)s' % (profile_name, region)))
+    return timed_manage_alarms(profile_name, region, sns_topic, options)
+
+def timed_manage_alarms(profile_name, region, sns_topic, options):
+    # manage_alarms() (manage_events() with --events), returning its summary
+    # plus the target, wall time and any error instead of raising
+    started = time.time()
+    try:
+        if options.events:
+            summary = manage_events(profile_name, region, sns_topic, options)
+        else:
+            summary = manage_alarms(profile_name, region, sns_topic, options)
+        summary["error"] = None
+    except Exception as e:
+        logging.exception("Failed to manage alarms")
+        summary = { "error": str(e) }
+    summary.update({ "profile_name": profile_name, "region": region, "started": started,
+                     "wall_time": time.time() - started })
+    return summary
+
+# Metrics in the Prometheus report: name (after the aws_manage_alarms_
+# prefix), type and help text
+prometheus_metrics = [
+    ("run_seconds", "gauge", "Wall time of the last run"),
+    ("run_failed", "gauge", "Whether the last run failed"),
+    ("last_run_timestamp_seconds", "gauge", "When the last run started"),
+    ("phase_seconds", "gauge", "Time the last run spent in each phase"),
+    ("api_calls", "gauge", "API calls made in the last run"),
+    ("api_throttles", "gauge", "API calls throttled in the last run"),
+    ("api_errors", "gauge", "API calls that failed otherwise in the last run"),
+    ("api_call_seconds", "histogram", "API call latency in the last run"),
+    ("alarms", "gauge", "Alarms the last run created, updated, deleted, left unchanged, skipped or cleaned up"),
+    ("mutation_retries", "gauge", "Alarm writes retried after throttling in the last run"),
+    ("mutations_failed", "gauge", "Alarm writes that failed in the last run"),
+]
+
+def prometheus_labels(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join('%s="%s"' % (k, escape(v)) for k, v in labels)
+
+def prometheus_report(results):
+    # The run results in the Prometheus text format, e.g. for
+    # node_exporter's textfile collector
+    samples = dict((name, []) for name, kind, help in prometheus_metrics)
+    for result in results:
+        target = [ ("profile", result["profile_name"]), ("region", result["region"]) ]
+        samples["run_seconds"].append(('', target, result["wall_time"]))
+        samples["run_failed"].append(('', target, 1 if result["error"] else 0))
+        samples["last_run_timestamp_seconds"].append(('', target, result["started"]))
+        if result["error"]:
+            continue
+        report = result["report"]
+        for phase, seconds in sorted(report["phases"].items()):
+            samples["phase_seconds"].append(('', target + [("phase", phase)], seconds))
+        for operation, stats in sorted(report["operations"].items()):
+            labels = target + [("operation", operation)]
+            samples["api_calls"].append(('', labels, stats["calls"]))
+            samples["api_throttles"].append(('', labels, stats["throttles"]))
+            samples["api_errors"].append(('', labels, stats["errors"]))
+            for bound, count in stats["buckets"]:
+                samples["api_call_seconds"].append(('_bucket', labels + [("le", bound)], count))
+            samples["api_call_seconds"].append(('_sum', labels, stats["seconds"]))
+            samples["api_call_seconds"].append(('_count', labels, stats["calls"]))
+        for resource_type, counts in sorted(report["alarms"].items()):
+            for action, count in sorted(counts.items()):
+                samples["alarms"].append(('', target + [("resource_type", resource_type), ("action", action)], count))
+        samples["mutation_retries"].append(('', target, result["throttled"]))
+        samples["mutations_failed"].append(('', target, result["failed"]))
+
+    lines = []
+    for name, kind, help in prometheus_metrics:
+        if not samples[name]:
+            continue
+        lines.append("# HELP aws_manage_alarms_%s %s" % (name, help))
+        lines.append("# TYPE aws_manage_alarms_%s %s" % (name, kind))
+        for suffix, labels, value in samples[name]:
+            lines.append("aws_manage_alarms_%s%s{%s} %s" % (name, suffix, prometheus_labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+def write_run_reports(results, options):
+    if options.report:
+        write_atomically(options.report, json.dumps(results, indent=2, sort_keys=True) + '\n')
+    if options.prometheus:
+        write_atomically(options.prometheus, prometheus_report(results))
+
+def get_targets(options):
+    # A targets file is a JSON list of {"profile_name", "region", "sns_topic"}
+    # objects; region and sns_topic fall back to -r/-s.  Otherwise it's every
+    # combination of --profiles and --regions.
+    if options.targets_file:
+        with open(options.targets_file) as infile:
+            targets = json.load(infile)
+        return [ (t["profile_name"], t.get("region", options.aws_region), t.get("sns_topic", options.sns_topic))
+                 for t in targets ]
+    profiles = options.profiles.split(',') if options.profiles else [options.profile_name]
+    regions  = options.regions.split(',') if options.regions else [options.aws_region]
+    return [ (p, r, options.sns_topic) for p in profiles for r in regions ]
+
+def fan_out(targets, options):
+    # Each (profile, region) runs in its own process, so the whole estate takes
+    # about as long as the slowest target.  Results are printed as they finish.
+    pool = multiprocessing.Pool(min(options.parallelism, len(targets)))
+    results = []
+    for result in pool.imap_unordered(run_target, [ t + (options,) for t in targets ]):
+        results.append(result)
+        if result["error"]:
+            print("%s/%s: FAILED after %.1fs: %s" % (result["profile_name"], result["region"], result["wall_time"], result["error"]))
+        else:
+            print("%s/%s: %s created, %s updated, %s deleted, %s unchanged (%s calls failed, %s throttled) in %.1fs" %
+                  (result["profile_name"], result["region"], result["created"], result["updated"], result["deleted"],
+                   result["unchanged"], result["failed"], result["throttled"], result["wall_time"]))
+        sys.stdout.flush()
+    pool.close()
+    pool.join()
+
+    failed = [ r for r in results if r["error"] ]
+    print("%s targets, %s failed; %s alarm changes; slowest target %.1fs" %
+          (len(results), len(failed), sum(r.get("completed", 0) for r in results),
+           max(r["wall_time"] for r in results)))
+    return results
+
+if __name__ == '__main__':
+    # Handle arguments
+    parser = argparse.ArgumentParser(description='Automatically create alerts')
+    parser.add_argument('-p', '--profile-name', default='default')
+    parser.add_argument('-r', '--aws-region', default='us-west-2')
+    parser.add_argument('-s', '--sns-topic')
+    parser.add_argument('-P', '--profiles', help="Comma-separated list of profiles to run against")
+    parser.add_argument('-R', '--regions', help="Comma-separated list of regions to run against")
+    parser.add_argument('-t', '--targets-file', help="JSON file listing the profile/region/sns_topic targets to run against")
+    parser.add_argument('-j', '--parallelism', type=int, default=4,
+                        help="Number of targets to run at once when there's more than one")
+    parser.add_argument('--policy-file', default=default_policy_file,
+                        help="JSON or YAML alarm policy (default: alarm_policy.json next to this script)")
+    parser.add_argument('--plan', action="store_true",
+                        help="Print the alarms that would be created, updated and deleted, and change nothing")
+    parser.add_argument('--cleanup', action="store_true",
+                        help="Delete INSUFFICIENT_DATA alarms whose resource is gone now, rather than waiting for Monday 8AM")
+    parser.add_argument('--cache-dir', default=default_cache_dir,
+                        help="Where to keep the inventory/alarm cache (default: ~/.cache/aws_manage_alarms)")
+    parser.add_argument('--cache-ttl', action='append', default=[], metavar='KIND=SECONDS',
+                        help="Override how long a kind of cached data (ec2, ebs, elasticache, rds, elb, metrics, alarms) is used for")
+    parser.add_argument('--no-cache', action="store_true", help="Don't read or write the cache")
+    parser.add_argument('--refresh', action="store_true", help="Ignore cached data, but write fresh data back")
+    parser.add_argument('-n', '--metric-namespace', action='append', default=[],
+                        help="Extra (custom) metric namespace to index; may be given more than once")
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help="Number of threads making alarm create/delete calls")
+    parser.add_argument('--mutation-rate', type=float, default=3.0,
+                        help="Alarm create/delete calls per second to start at")
+    parser.add_argument('--max-mutation-rate', type=float, default=20.0,
+                        help="Ceiling the call rate may ramp up to while calls keep succeeding")
+    parser.add_argument('--events', metavar='SOURCE',
+                        help="Only reconcile the resources named in EventBridge/CloudTrail events read from SOURCE: "
+                             "an SQS queue URL, a JSON-lines file, or - for stdin")
+    parser.add_argument('--metric-wait', type=int, default=900,
+                        help="How long (seconds) to keep retrying queued events for resources whose metrics "
+                             "haven't reported yet (default 900)")
+    parser.add_argument('--report', metavar='PATH',
+                        help="Write a JSON report of the run (phase timings, API calls, alarm changes) to PATH")
+    parser.add_argument('--prometheus', metavar='PATH',
+                        help="Write the run report to PATH in the Prometheus text format, for node_exporter's textfile collector")
+    parser.add_argument('--refresh-instance-catalog', metavar='DUMP',
+                        help="Regenerate instance_types.json from an instance type JSON dump and exit")
+    parser.add_argument('-v', '--verbose', help="Set logging level to INFO", action="store_true")
+    parser.add_argument('-vv', '--verbose-debug', help="Set logging level to DEBUG", action="store_true")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    elif args.verbose_debug:
+        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    else:
+        logging.basicConfig(stream=sys.stderr, level=logging.WARN)
+
+    if args.refresh_instance_catalog:
+        count = refresh_instance_catalog(args.refresh_instance_catalog)
+        print("Wrote %s instance types to %s" % (count, default_instance_catalog_file))
+        sys.exit(0)
+
+    targets = get_targets(args)
+
+    # Check the policy compiles for every account before starting any work
+    try:
+        args.policy = load_policy(args.policy_file)
+        for profile_name in set(t[0] for t in targets):
+            CompiledPolicy(args.policy, profile_name)
+    except (IOError, KeyError, ValueError, SyntaxError, re.error) as e:
+        parser.error("Bad policy file %s: %s" % (args.policy_file, e))
+    if args.events and len(targets) > 1:
+        parser.error("--events works on one profile and region at a time")
+    if len(targets) == 1:
+        profile_name, region, sns_topic = targets[0]
+        results = [ timed_manage_alarms(profile_name, region, sns_topic, args) ]
+    else:
+        results = fan_out(targets, args)
+    write_run_reports(results, args)
+    if any(r["error"] for r in results):
+        sys.exit(1)
@@ -0,0 +1,132 @@
+#! /usr/bin/env python
+# Benchmark aws_manage_alarms.py against synthetic fleets in fake_aws, e.g.
+#
+#   bench_alarms.py --sizes 100,1000,10000 --latency 0.01 --throttle-rate 0.02
+#
+# For each fleet size it does a full run (every alarm to create, plus
+# orphaned and unrelated alarms already there), a converged run (nothing to
+# do) and an --events run for one instance launched and one terminated,
+# reporting wall time, API calls by action, peak memory and alarms
+# reconciled per second.  Each run happens in a process of its own, so peak
+# memory is that run's rather than the highest of all the runs so far.
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import aws_manage_alarms
+import fake_aws
+
+def run_options(args, cache_dir):
+    # What manage_alarms() would get from the command line
+    return argparse.Namespace(policy=aws_manage_alarms.load_policy(args.policy_file), plan=False,
+                              cleanup=args.cleanup, no_cache=not args.cache, cache_dir=cache_dir,
+                              cache_ttl=[], refresh=False, metric_namespace=[], workers=args.workers,
+                              mutation_rate=args.mutation_rate, max_mutation_rate=args.mutation_rate,
+                              events=None, metric_wait=0, report=None, prometheus=None)
+
+def state_change_event(instance_id, state):
+    # As EventBridge has it
+    return { "detail-type": "EC2 Instance State-change Notification", "source": "aws.ec2", "region": "us-east-1",
+             "resources": [ "arn:aws:ec2:us-east-1:000000000000:instance/%s" % instance_id ],
+             "detail": { "instance-id": instance_id, "state": state } }
+
+def timed_run(aws, options, name, manage=aws_manage_alarms.manage_alarms):
+    calls_before = aws.calls.copy()
+    started = time.time()
+    summary = manage('bench', 'us-east-1', 'arn:aws:sns:us-east-1:000000000000:bench', options)
+    wall_time = time.time() - started
+    calls = aws.calls - calls_before
+    reconciled = summary["created"] + summary["updated"] + summary["deleted"] + summary["unchanged"]
+    return { "run": name, "wall_time": wall_time, "api_calls": sum(calls.values()), "calls": dict(calls),
+             "created": summary["created"], "updated": summary["updated"], "deleted": summary["deleted"],
+             "unchanged": summary["unchanged"], "failed": summary["failed"], "throttled": summary["throttled"],
+             "alarms_per_sec": reconciled / max(wall_time, 0.001), "phases": summary["report"]["phases"],
+             # ru_maxrss is in KB on Linux.  A forked process starts from what
+             # its parent has in use, not from the parent's peak.
+             "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 }
+
+def run_scenarios(aws, options, scenarios, results):
+    # Do the first run here and the rest in a process forked from this one,
+    # so each starts from the state the run before it left behind
+    name, prepare, manage = scenarios[0]
+    if prepare:
+        prepare()
+    results.put(timed_run(aws, options, name, manage))
+    if scenarios[1:]:
+        worker = multiprocessing.Process(target=run_scenarios, args=(aws, options, scenarios[1:], results))
+        worker.start()
+        worker.join()
+
+def bench_size(args, size, results):
+    aws = fake_aws.FakeAWS(latency=args.latency, throttle_rate=args.throttle_rate, write_quota=args.write_quota,
+                           seed=size)
+    aws.add_fleet(size, alarms=int(size * args.existing_alarms))
+    aws_manage_alarms.backend = fake_aws.FakeBackend(aws)
+    cache_dir = tempfile.mkdtemp(prefix='bench_alarms')
+    options = run_options(args, cache_dir)
+
+    def launch_and_terminate():
+        launched, = aws.launch("ec2")
+        aws.terminate("ec2", aws.instances[0].id)
+        options.events = os.path.join(cache_dir, 'events.json')
+        with open(options.events, 'w') as outfile:
+            for event in [ state_change_event(launched, 'running'), state_change_event(aws.instances[0].id, 'terminated') ]:
+                outfile.write(json.dumps(event) + '\n')
+
+    try:
+        run_scenarios(aws, options, [ ("full", None, aws_manage_alarms.manage_alarms),
+                                      ("converged", None, aws_manage_alarms.manage_alarms),
+                                      ("events", launch_and_terminate, aws_manage_alarms.manage_events) ], results)
+    finally:
+        shutil.rmtree(cache_dir)
+    results.put(None)
+
+def report(runs):
+    print("%9s  %-9s  %9s  %9s  %8s  %8s  %8s  %12s  %s" %
+          ("resources", "run", "wall (s)", "API calls", "changes", "unchanged", "peak MB", "alarms/sec", "calls"))
+    for run in runs:
+        calls = ', '.join("%s=%s" % (k, v) for k, v in sorted(run["calls"].items()))
+        print("%9s  %-9s  %9.2f  %9s  %8s  %8s  %8.1f  %12.1f  %s" %
+              (run["resources"], run["run"], run["wall_time"], run["api_calls"],
+               run["created"] + run["updated"] + run["deleted"], run["unchanged"], run["peak_rss_mb"],
+               run["alarms_per_sec"], calls))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark aws_manage_alarms against fake fleets')
+    parser.add_argument('--sizes', default='100,1000,10000', help="Comma-separated fleet sizes (default 100,1000,10000)")
+    parser.add_argument('--existing-alarms', type=float, default=0.5,
+                        help="Alarms already there that the script didn't make, per resource (default 0.5)")
+    parser.add_argument('--latency', type=float, default=0, help="Seconds each fake API call takes")
+    parser.add_argument('--throttle-rate', type=float, default=0, help="Fraction of alarm writes that get throttled at random")
+    parser.add_argument('--write-quota', type=float, help="Alarm writes per second beyond which writes get throttled")
+    parser.add_argument('--policy-file', default=aws_manage_alarms.default_policy_file)
+    parser.add_argument('-w', '--workers', type=int, default=8)
+    parser.add_argument('--mutation-rate', type=float, default=1000,
+                        help="Alarm write rate the script starts at and may ramp up to (default 1000/sec)")
+    parser.add_argument('--cache', action="store_true", help="Use the inventory cache (in a temporary directory)")
+    parser.add_argument('--cleanup', action="store_true", help="Include the INSUFFICIENT_DATA cleanup")
+    parser.add_argument('--json', help="Also write the results to this file as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.ERROR)
+
+    runs = []
+    for size in [ int(s) for s in args.sizes.split(',') ]:
+        results = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=bench_size, args=(args, size, results))
+        worker.start()
+        for run in iter(results.get, None):
+            run["resources"] = size
+            runs.append(run)
+        worker.join()
+    report(runs)
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(runs, outfile, indent=2)
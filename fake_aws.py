@@ -0,0 +1,466 @@
+#! /usr/bin/env python
+# In-memory stand-in for the parts of CloudWatch, EC2, EBS, RDS, ElastiCache
+# and ELB that aws_manage_alarms.py uses, so runs can be measured without an
+# AWS account:
+#
+#   aws = fake_aws.FakeAWS(latency=0.02, throttle_rate=0.05)
+#   aws.add_fleet(1000, alarms=500)
+#   aws_manage_alarms.backend = fake_aws.FakeBackend(aws)
+#
+# aws.launch() and aws.terminate() change the fleet between runs, and
+# aws.send() queues an event for --events https://sqs... runs.  Every API
+# call is counted by action in aws.calls.  Each call sleeps `latency`
+# seconds.  Alarm writes fail with a Throttling error at random
+# (`throttle_rate` of them) and/or beyond `write_quota` per second, like
+# CloudWatch's PutMetricAlarm quota; aws.fail() throttles the next calls
+# of any action.
+import datetime
+import fnmatch
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+
+from boto.ec2.cloudwatch.metric import Metric
+from boto.exception import BotoServerError
+from boto.resultset import ResultSet
+
+from aws_manage_alarms import ManagedAlarm, ManagedAlarms
+
+# Metrics each kind of resource reports, by namespace
+resource_metrics = {
+    "ec2": [ ('AWS/EC2', 'CPUUtilization'), ('AWS/EC2', 'StatusCheckFailed'), ('AWS/EC2', 'NetworkIn'),
+             ('AWS/EC2', 'NetworkOut'), ('System/Linux', 'MemoryUtilization') ],
+    "ebs": [ ('AWS/EBS', 'BurstBalance'), ('AWS/EBS', 'VolumeReadOps'), ('AWS/EBS', 'VolumeWriteOps') ],
+    "rds": [ ('AWS/RDS', 'CPUUtilization'), ('AWS/RDS', 'SwapUsage'), ('AWS/RDS', 'FreeStorageSpace'),
+             ('AWS/RDS', 'EngineUptime'), ('AWS/RDS', 'DatabaseConnections') ],
+    "elasticache": [ ('AWS/ElastiCache', 'BytesUsedForCache'), ('AWS/ElastiCache', 'Evictions'),
+                     ('AWS/ElastiCache', 'CurrConnections'), ('AWS/ElastiCache', 'FreeableMemory') ],
+    "elb": [ ('AWS/ELB', 'UnHealthyHostCount'), ('AWS/ELB', 'HealthyHostCount'),
+             ('AWS/ELB', 'HTTPCode_Backend_5XX') ],
+}
+# Burstable types also report CPUCreditBalance
+burstable_metrics = { "ec2": ('AWS/EC2', 'CPUCreditBalance'), "rds": ('AWS/RDS', 'CPUCreditBalance') }
+
+# How a synthetic fleet is split between resource types
+fleet_mix = [ ("ec2", 0.5), ("ebs", 0.3), ("rds", 0.08), ("elasticache", 0.06), ("elb", 0.06) ]
+ec2_types = [ 't2.small', 't3.medium', 'm5.large', 'm5.xlarge', 'c5.2xlarge', 'r5.large' ]
+rds_types = [ 'db.t2.small', 'db.t3.medium', 'db.m5.large', 'db.r5.xlarge' ]
+cache_types = [ 'cache.t2.small', 'cache.m5.large', 'cache.r5.large' ]
+
+dimension_names = { "ec2": "InstanceId", "ebs": "VolumeId", "rds": "DBInstanceIdentifier",
+                    "elasticache": "CacheClusterId", "elb": "LoadBalancerName" }
+
+# Alarm writes, which throttle_rate and write_quota apply to
+write_actions = [ 'PutMetricAlarm', 'PutCompositeAlarm', 'DeleteAlarms' ]
+
+class FakeResource(object):
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+def result_set(items, **tokens):
+    result = ResultSet()
+    result.extend(items)
+    result.next_token = result.marker = result.next_marker = None
+    for name, value in tokens.items():
+        setattr(result, name, value)
+    return result
+
+def not_found(error_code):
+    error = BotoServerError(404, 'Not Found')
+    error.error_code = error_code
+    return error
+
+def page(items, token, size):
+    # The items for one page, and the token for the next page (None if last)
+    start = int(token or 0)
+    end = start + size
+    return items[start:end], (str(end) if end < len(items) else None)
+
+def matches_filters(resource, filters, attributes):
+    # EC2 filters, as far as the script uses them: lists of wildcard patterns
+    # on launch-time/create-time, or ids
+    for name, patterns in (filters or {}).items():
+        if name not in attributes:
+            raise NotImplementedError("fake_aws doesn't support the %s filter" % name)
+        if isinstance(patterns, basestring):
+            patterns = [patterns]
+        if not any(fnmatch.fnmatch(getattr(resource, attributes[name]), p) for p in patterns):
+            return False
+    return True
+
+class FakeAWS(object):
+    # One account/region's worth of resources, metrics and alarms, shared by
+    # all the connections FakeBackend hands out
+    def __init__(self, latency=0, throttle_rate=0, write_quota=None, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.write_quota = write_quota
+        self.recent_writes = deque()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.instances = []
+        self.volumes = []
+        self.db_instances = []
+        self.cache_clusters = []
+        self.load_balancers = []
+        self.metrics = {}       # namespace -> [Metric]
+        self.dimensions = {}    # (dimension name, value) -> [Metric]
+        self.alarms = {}        # name -> ManagedAlarm
+        self.messages = []      # SQS messages not yet deleted
+        self.failing = Counter()  # action -> calls still to throttle
+
+    def call(self, action):
+        with self.lock:
+            self.calls[action] += 1
+            throttled = self.failing[action] > 0
+            if throttled:
+                self.failing[action] -= 1
+            elif action in write_actions:
+                throttled = self.random.random() < self.throttle_rate
+                if self.write_quota and not throttled:
+                    now = time.time()
+                    while self.recent_writes and self.recent_writes[0] < now - 1:
+                        self.recent_writes.popleft()
+                    throttled = len(self.recent_writes) >= self.write_quota
+                    if not throttled:
+                        self.recent_writes.append(now)
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            error = BotoServerError(400, 'Bad Request')
+            error.error_code = 'Throttling'
+            raise error
+
+    def add_metric(self, namespace, name, dimension_name, value):
+        metric = Metric()
+        metric.namespace, metric.name, metric.dimensions = namespace, name, { dimension_name: [value] }
+        self.metrics.setdefault(namespace, []).append(metric)
+        self.dimensions.setdefault((dimension_name, value), []).append(metric)
+
+    def add_resource(self, resource_type, number, created):
+        launched = created.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        if resource_type == "ec2":
+            resource_id = 'i-%017x' % number
+            instance_class = self.random.choice(ec2_types)
+            tags = { 'Name': 'web-%s' % number, 'aws:autoscaling:groupName': 'asg-%s' % (number % 50) }
+            self.instances.append(FakeResource(id=resource_id, tags=tags, instance_type=instance_class,
+                                               launch_time=launched, state='running'))
+        elif resource_type == "ebs":
+            resource_id = 'vol-%017x' % number
+            instance_class = None
+            self.volumes.append(FakeResource(id=resource_id, tags={}, create_time=launched))
+        elif resource_type == "rds":
+            resource_id = 'db-%s' % number
+            instance_class = self.random.choice(rds_types)
+            self.db_instances.append(FakeResource(id=resource_id, instance_class=instance_class,
+                                                  allocated_storage=self.random.choice([0, 100, 500])))
+        elif resource_type == "elasticache":
+            resource_id = 'cache-%s' % number
+            instance_class = self.random.choice(cache_types)
+            self.cache_clusters.append({ 'CacheClusterId': resource_id, 'CacheNodeType': instance_class })
+        else:
+            resource_id = 'lb-%s' % number
+            instance_class = None
+            self.load_balancers.append(FakeResource(name=resource_id, tags={ 'team': 'team-%s' % (number % 5) }))
+        metrics = list(resource_metrics[resource_type])
+        if instance_class and instance_class.replace('db.', '').startswith('t'):
+            metrics.append(burstable_metrics.get(resource_type))
+        for namespace, name in filter(None, metrics):
+            self.add_metric(namespace, name, dimension_names[resource_type], resource_id)
+        return resource_id
+
+    def add_fleet(self, resources, alarms=0, profile_name='bench'):
+        # `resources` resources split per fleet_mix, plus `alarms` alarms
+        # the script didn't make: half unrelated, half left in
+        # INSUFFICIENT_DATA on EC2 instances that are gone
+        created = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+        number = 0
+        for resource_type, share in fleet_mix:
+            for i in range(max(1, int(resources * share))):
+                number += 1
+                self.add_resource(resource_type, number, created)
+        for i in range(alarms):
+            if i % 2:
+                alarm = ManagedAlarm(name='other-alarm-%s' % i, metric='Errors', namespace='Custom',
+                                     statistic='Sum', comparison='>', threshold=1, period=60,
+                                     evaluation_periods=1, dimensions={ 'Service': ['svc-%s' % i] })
+                alarm.state_value = 'OK'
+            else:
+                gone = 'i-gone%012x' % i
+                alarm = ManagedAlarm(name='%s-ec2-%s-CPUUtilization' % (profile_name, gone), metric='CPUUtilization',
+                                     namespace='AWS/EC2', statistic='Average', comparison='>=', threshold=90,
+                                     period=60, evaluation_periods=5, dimensions={ 'InstanceId': [gone] })
+                alarm.state_value = 'INSUFFICIENT_DATA'
+            self.alarms[alarm.name] = alarm
+
+    def fail(self, action, times=1):
+        # Throttle the next `times` calls of an API action
+        with self.lock:
+            self.failing[action] += times
+
+    def send(self, event):
+        # Queue an event, as EventBridge would
+        self.messages.append(FakeMessage(json.dumps(event), sent=time.time()))
+
+    def launch(self, resource_type, count=1):
+        # Add resources as if just created, for incremental runs
+        number = len(self.instances) + len(self.volumes) + len(self.db_instances) + \
+                 len(self.cache_clusters) + len(self.load_balancers)
+        return [ self.add_resource(resource_type, number + i + 1, datetime.datetime.utcnow())
+                 for i in range(count) ]
+
+    def terminate(self, resource_type, resource_id):
+        # Terminated instances linger for a while; everything else just goes.
+        # Metrics stay, as they do in CloudWatch.
+        if resource_type == "ec2":
+            for instance in self.instances:
+                if instance.id == resource_id:
+                    instance.state = 'terminated'
+        elif resource_type == "ebs":
+            self.volumes = [ v for v in self.volumes if v.id != resource_id ]
+        elif resource_type == "rds":
+            self.db_instances = [ i for i in self.db_instances if i.id != resource_id ]
+        elif resource_type == "elasticache":
+            self.cache_clusters = [ c for c in self.cache_clusters if c['CacheClusterId'] != resource_id ]
+        else:
+            self.load_balancers = [ lb for lb in self.load_balancers if lb.name != resource_id ]
+
+class FakeCloudWatch(object):
+    def __init__(self, aws):
+        self.aws = aws
+
+    def build_list_params(self, params, items, label):
+        for i, item in enumerate(items):
+            params['%s.%d' % (label, i + 1)] = item
+
+    def list_metrics(self, next_token=None, dimensions=None, metric_name=None, namespace=None):
+        self.aws.call('ListMetrics')
+        if dimensions:
+            (name, value), = dimensions.items()
+            metrics = self.aws.dimensions.get((name, value), [])
+        elif namespace:
+            metrics = self.aws.metrics.get(namespace, [])
+        else:
+            metrics = [ m for ms in self.aws.metrics.values() for m in ms ]
+        metrics = [ m for m in metrics if (namespace is None or m.namespace == namespace) and
+                                          (metric_name is None or m.name == metric_name) ]
+        items, token = page(metrics, next_token, 500)
+        return result_set(items, next_token=token)
+
+    def get_list(self, action, params, markers, verb='GET'):
+        # Only DescribeAlarms comes through here
+        self.aws.call(action)
+        with self.aws.lock:
+            alarms = [ self.aws.alarms[n] for n in sorted(self.aws.alarms) ]
+        if params.get('StateValue'):
+            alarms = [ a for a in alarms if a.state_value == params['StateValue'] ]
+        if params.get('AlarmNamePrefix'):
+            alarms = [ a for a in alarms if a.name.startswith(params['AlarmNamePrefix']) ]
+        items, token = page(alarms, params.get('NextToken'), 100)
+        metric_alarms, composite_alarms = ManagedAlarms(), ManagedAlarms()
+        for alarm in items:
+            (composite_alarms if alarm.alarm_rule else metric_alarms).append(alarm)
+        return result_set([ metric_alarms, composite_alarms ], next_token=token)
+
+    def store(self, alarm):
+        alarm.state_value = 'INSUFFICIENT_DATA'
+        with self.aws.lock:
+            self.aws.alarms[alarm.name] = alarm
+
+    def put_metric_alarm(self, alarm):
+        self.aws.call('PutMetricAlarm')
+        self.store(ManagedAlarm(name=alarm.name, metric=alarm.metric, namespace=alarm.namespace,
+                                statistic=alarm.statistic, comparison=ManagedAlarm._rev_cmp_map[alarm.comparison],
+                                threshold=alarm.threshold, period=alarm.period,
+                                evaluation_periods=alarm.evaluation_periods,
+                                dimensions=dict((k, list(v)) for k, v in alarm.dimensions.items()),
+                                alarm_actions=list(alarm.alarm_actions or []), ok_actions=list(alarm.ok_actions or [])))
+
+    def get_status(self, action, params, verb='GET'):
+        # PutMetricAlarm (metric math) and PutCompositeAlarm
+        self.aws.call(action)
+        def members(label):
+            values, i = [], 1
+            while '%s.member.%d' % (label, i) in params:
+                values.append(params['%s.member.%d' % (label, i)])
+                i += 1
+            return values
+        metrics, i = [], 1
+        while 'Metrics.member.%d.Id' % i in params:
+            prefix = 'Metrics.member.%d.' % i
+            query = { "id": params[prefix + 'Id'], "return_data": params[prefix + 'ReturnData'] == 'true' }
+            if prefix + 'Expression' in params:
+                query["expression"] = params[prefix + 'Expression']
+                if prefix + 'Label' in params:
+                    query["label"] = params[prefix + 'Label']
+            else:
+                query.update({ "metric": params[prefix + 'MetricStat.Metric.MetricName'],
+                               "namespace": params[prefix + 'MetricStat.Metric.Namespace'],
+                               "period": int(params[prefix + 'MetricStat.Period']),
+                               "statistic": params[prefix + 'MetricStat.Stat'], "dimensions": {} })
+                j = 1
+                while prefix + 'MetricStat.Metric.Dimensions.member.%d.Name' % j in params:
+                    dimension = prefix + 'MetricStat.Metric.Dimensions.member.%d.' % j
+                    query["dimensions"].setdefault(params[dimension + 'Name'], []).append(params[dimension + 'Value'])
+                    j += 1
+            metrics.append(query)
+            i += 1
+        comparison = params.get('ComparisonOperator')
+        self.store(ManagedAlarm(name=params['AlarmName'], alarm_rule=params.get('AlarmRule'), metrics=metrics or None,
+                                comparison=ManagedAlarm._rev_cmp_map.get(comparison),
+                                threshold=params.get('Threshold'), evaluation_periods=params.get('EvaluationPeriods'),
+                                alarm_actions=members('AlarmActions'), ok_actions=members('OKActions')))
+        return True
+
+    def delete_alarms(self, names):
+        self.aws.call('DeleteAlarms')
+        with self.aws.lock:
+            for name in names:
+                self.aws.alarms.pop(name, None)
+
+class FakeEC2(object):
+    def __init__(self, aws):
+        self.aws = aws
+
+    def build_filter_params(self, params, filters):
+        for i, (name, values) in enumerate(sorted(filters.items())):
+            params['Filter.%d.Name' % (i + 1)] = name
+            for j, value in enumerate(values):
+                params['Filter.%d.Value.%d' % (i + 1, j + 1)] = value
+
+    def get_all_reservations(self, filters=None, max_results=None, next_token=None):
+        self.aws.call('DescribeInstances')
+        instances = [ i for i in self.aws.instances
+                      if matches_filters(i, filters, { 'launch-time': 'launch_time', 'instance-id': 'id' }) ]
+        items, token = page(instances, next_token, max_results or 1000)
+        return result_set([ FakeResource(instances=[i]) for i in items ], next_token=token)
+
+    def get_list(self, action, params, markers, verb='GET'):
+        # Only DescribeVolumes comes through here
+        self.aws.call(action)
+        filters, i = {}, 1
+        while 'Filter.%d.Name' % i in params:
+            values, j = [], 1
+            while 'Filter.%d.Value.%d' % (i, j) in params:
+                values.append(params['Filter.%d.Value.%d' % (i, j)])
+                j += 1
+            filters[params['Filter.%d.Name' % i]] = values
+            i += 1
+        volumes = [ v for v in self.aws.volumes
+                    if matches_filters(v, filters, { 'create-time': 'create_time', 'volume-id': 'id' }) ]
+        items, token = page(volumes, params.get('NextToken'), int(params.get('MaxResults', 500)))
+        return result_set(items, next_token=token)
+
+class FakeRDS(object):
+    def __init__(self, aws):
+        self.aws = aws
+
+    def get_all_dbinstances(self, instance_id=None, max_records=None, marker=None):
+        self.aws.call('DescribeDBInstances')
+        instances = self.aws.db_instances
+        if instance_id:
+            instances = [ i for i in instances if i.id == instance_id ]
+            if not instances:
+                raise not_found('DBInstanceNotFound')
+        items, token = page(instances, marker, max_records or 100)
+        return result_set(items, marker=token)
+
+class FakeElastiCache(object):
+    def __init__(self, aws):
+        self.aws = aws
+
+    def describe_cache_clusters(self, cache_cluster_id=None, max_records=None, marker=None):
+        self.aws.call('DescribeCacheClusters')
+        clusters = self.aws.cache_clusters
+        if cache_cluster_id:
+            clusters = [ c for c in clusters if c['CacheClusterId'] == cache_cluster_id ]
+            if not clusters:
+                raise not_found('CacheClusterNotFound')
+        items, token = page(clusters, marker, max_records or 100)
+        return { 'DescribeCacheClustersResponse': {
+                     'DescribeCacheClustersResult': { 'CacheClusters': items, 'Marker': token } } }
+
+class FakeELB(object):
+    def __init__(self, aws):
+        self.aws = aws
+
+    def get_all_load_balancers(self, load_balancer_names=None, marker=None):
+        self.aws.call('DescribeLoadBalancers')
+        load_balancers = self.aws.load_balancers
+        if load_balancer_names:
+            load_balancers = [ lb for lb in load_balancers if lb.name in load_balancer_names ]
+            if len(load_balancers) < len(load_balancer_names):
+                raise not_found('LoadBalancerNotFound')
+        items, token = page(load_balancers, marker, 400)
+        return result_set(items, next_marker=token)
+
+    def build_list_params(self, params, items, label):
+        for i, item in enumerate(items):
+            params['%s.%d' % (label, i + 1)] = item
+
+    def get_list(self, action, params, markers, verb='GET'):
+        # Only DescribeTags comes through here
+        self.aws.call(action)
+        names = [ v for k, v in sorted(params.items()) if k.startswith('LoadBalancerNames.member.') ]
+        if len(names) > 20:
+            raise BotoServerError(400, 'Bad Request')
+        return result_set([ FakeResource(name=lb.name, tags=lb.tags) for lb in self.aws.load_balancers
+                            if lb.name in names ])
+
+class FakeMessage(object):
+    def __init__(self, body, sent):
+        self.body = body
+        self.attributes = { 'SentTimestamp': str(int(sent * 1000)) }
+
+    def get_body(self):
+        return self.body
+
+class FakeSQS(object):
+    # One queue, whatever it's called.  Messages have no visibility timeout:
+    # anything not deleted comes back on the next receive.  Once the queue is
+    # empty, receiving raises KeyboardInterrupt, as if the run were
+    # interrupted, so an --events run ends.
+    def __init__(self, aws):
+        self.aws = aws
+
+    def get_queue(self, name, owner_acct_id=None):
+        self.aws.call('GetQueueUrl')
+        return FakeResource(url='https://sqs.us-east-1.amazonaws.com/%s/%s' % (owner_acct_id, name),
+                            set_message_class=lambda cls: None)
+
+    def receive_message(self, queue, number_messages=1, wait_time_seconds=None, attributes=None):
+        self.aws.call('ReceiveMessage')
+        if not self.aws.messages:
+            raise KeyboardInterrupt()
+        return self.aws.messages[:number_messages]
+
+    def delete_message_batch(self, queue, messages):
+        self.aws.call('DeleteMessageBatch')
+        self.aws.messages = [ m for m in self.aws.messages if m not in messages ]
+
+class FakeBackend(object):
+    # Drop-in for aws_manage_alarms.BotoBackend; every profile and region
+    # is the same FakeAWS
+    def __init__(self, aws):
+        self.aws = aws
+
+    def cloudwatch(self, region, profile_name):
+        return FakeCloudWatch(self.aws)
+
+    def ec2(self, region, profile_name):
+        return FakeEC2(self.aws)
+
+    def elasticache(self, region, profile_name):
+        return FakeElastiCache(self.aws)
+
+    def rds(self, region, profile_name):
+        return FakeRDS(self.aws)
+
+    def elb(self, region, profile_name):
+        return FakeELB(self.aws)
+
+    def sqs(self, region, profile_name):
+        return FakeSQS(self.aws)
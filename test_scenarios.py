@@ -0,0 +1,182 @@
+#! /usr/bin/env python
+# Runs aws_manage_alarms.py more than once against fake_aws, changing the
+# fleet in between, and checks each run leaves the alarms it should:
+#
+#   python -m unittest test_scenarios
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import aws_manage_alarms
+import fake_aws
+from aws_manage_alarms import ManagedAlarm
+
+logging.basicConfig(level=logging.CRITICAL)
+
+# Not 'test': alarm_policy.json leaves alarms with that in their names alone
+profile_name, region, sns_topic = 'scenario', 'us-east-1', 'arn:aws:sns:us-east-1:000000000000:scenario'
+
+def instance_event(instance_id):
+    arn = "arn:aws:ec2:%s:000000000000:instance/%s" % (region, instance_id)
+    return { "source": "aws.ec2", "resources": [ arn ] }
+
+class ScenarioTest(unittest.TestCase):
+    def setUp(self):
+        self.aws = fake_aws.FakeAWS(seed=1)
+        self.aws.add_fleet(50, alarms=10, profile_name=profile_name)
+        aws_manage_alarms.backend = fake_aws.FakeBackend(self.aws)
+        self.cache_dir = tempfile.mkdtemp(prefix='test_scenarios')
+        self.options = argparse.Namespace(policy=aws_manage_alarms.load_policy(aws_manage_alarms.default_policy_file),
+                                          plan=False, cleanup=False, no_cache=False, cache_dir=self.cache_dir,
+                                          cache_ttl=[], refresh=False, metric_namespace=[], workers=4,
+                                          mutation_rate=1000, max_mutation_rate=1000, events=None,
+                                          metric_wait=0, report=None, prometheus=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def run_full(self, refresh=False):
+        self.options.refresh = refresh
+        summary = aws_manage_alarms.manage_alarms(profile_name, region, sns_topic, self.options)
+        self.assertEqual(summary["failed"], 0)
+        return summary
+
+    def run_events(self, *resource_ids):
+        self.options.events = os.path.join(self.cache_dir, 'events.json')
+        with open(self.options.events, 'w') as outfile:
+            for resource_id in resource_ids:
+                outfile.write(json.dumps(instance_event(resource_id)) + '\n')
+        return self.manage_events()
+
+    def run_queue(self, *resource_ids):
+        # The same, through (fake) SQS; the run ends once the queue is empty
+        for resource_id in resource_ids:
+            self.aws.send(instance_event(resource_id))
+        self.options.events = 'https://sqs.%s.amazonaws.com/000000000000/events' % region
+        return self.manage_events()
+
+    def manage_events(self):
+        try:
+            return aws_manage_alarms.manage_events(profile_name, region, sns_topic, self.options)
+        finally:
+            self.options.events = None
+
+    def alarms_for(self, resource_id):
+        return sorted(name for name, alarm in self.aws.alarms.items()
+                      if resource_id in sum(alarm.dimensions.values(), []))
+
+    def converge(self):
+        self.assertTrue(self.run_full()["created"] > 0)
+        summary = self.run_full()
+        self.assertEqual(summary["created"] + summary["updated"] + summary["deleted"], 0)
+
+    def test_fleet_changes(self):
+        self.converge()
+        kept = self.aws.instances[1].id
+        before = self.alarms_for(kept)
+        launched, = self.aws.launch("ec2")
+        gone = self.aws.instances[0].id
+        self.aws.terminate("ec2", gone)
+        # Within the TTL the cache picks up launches but not terminations
+        summary = self.run_full()
+        self.assertTrue(self.alarms_for(launched))
+        self.assertEqual(summary["created"], len(self.alarms_for(launched)))
+        self.assertEqual(summary["deleted"], 0)
+        summary = self.run_full(refresh=True)
+        self.assertEqual(self.alarms_for(gone), [])
+        self.assertEqual(self.alarms_for(kept), before)
+        self.assertEqual(summary["created"] + summary["updated"], 0)
+        summary = self.run_full()
+        self.assertEqual(summary["created"] + summary["updated"] + summary["deleted"], 0)
+
+    def test_shared_names(self):
+        # Instances with the same Name tag want the same alarm names; which
+        # one gets them mustn't depend on the order they're listed in
+        first, second = self.aws.instances[0], self.aws.instances[1]
+        first.tags['Name'] = second.tags['Name'] = 'web'
+        first.instance_type = second.instance_type
+        self.converge()
+        owners = dict((name, self.aws.alarms[name].dimensions['InstanceId'])
+                      for name in self.alarms_for(first.id) + self.alarms_for(second.id))
+        self.assertEqual(set(sum(owners.values(), [])), set([ min(first.id, second.id) ]))
+        self.aws.instances[0], self.aws.instances[1] = second, first
+        summary = self.run_full(refresh=True)
+        self.assertEqual(summary["created"] + summary["updated"] + summary["deleted"], 0)
+
+    def test_cleanup_spares_alarms_on_new_resources(self):
+        # The cleanup must go by what's there now, not by the cached list
+        self.converge()
+        db, = self.aws.launch("rds")
+        alarm = ManagedAlarm(name='team-db-alarm', metric='CPUUtilization', namespace='AWS/RDS', statistic='Average',
+                             comparison='>', threshold=1, period=60, evaluation_periods=1,
+                             dimensions={ 'DBInstanceIdentifier': [db] })
+        alarm.state_value = 'INSUFFICIENT_DATA'
+        self.aws.alarms[alarm.name] = alarm
+        self.options.cleanup = True
+        self.run_full()
+        self.assertIn('team-db-alarm', self.aws.alarms)
+        self.assertFalse([ name for name in self.aws.alarms if 'i-gone' in name ])
+
+    def test_alarms_once_metrics_report(self):
+        self.converge()
+        launched = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        self.aws.instances.append(fake_aws.FakeResource(id='i-quiet', tags={ 'Name': 'quiet' }, instance_type='m5.large',
+                                                        launch_time=launched, state='running'))
+        self.run_full()
+        self.assertEqual(self.alarms_for('i-quiet'), [])
+        self.aws.add_metric('AWS/EC2', 'CPUUtilization', 'InstanceId', 'i-quiet')
+        self.run_full()
+        self.assertTrue(self.alarms_for('i-quiet'))
+        lookups = self.aws.calls['ListMetrics']
+        self.run_full()
+        self.assertEqual(self.aws.calls['ListMetrics'], lookups)
+
+    def test_events_and_full_runs_agree(self):
+        self.converge()
+        launched, = self.aws.launch("ec2")
+        gone = self.aws.instances[0].id
+        self.aws.terminate("ec2", gone)
+        summary = self.run_events(launched, gone)
+        self.assertTrue(summary["created"] > 0)
+        self.assertTrue(summary["deleted"] > 0)
+        self.assertEqual(self.alarms_for(gone), [])
+        summary = self.run_full()
+        self.assertEqual(summary["created"] + summary["updated"] + summary["deleted"], 0)
+
+    def test_full_run_then_events(self):
+        self.converge()
+        gone = self.aws.instances[0].id
+        self.aws.terminate("ec2", gone)
+        self.assertTrue(self.run_full(refresh=True)["deleted"] > 0)
+        summary = self.run_events(gone)
+        self.assertEqual(summary["created"] + summary["deleted"], 0)
+        self.assertEqual(self.run_full()["created"], 0)
+
+    def test_queue_survives_errors(self):
+        # A throttled describe fails its batch, which is delivered again
+        # rather than ending the run
+        self.converge()
+        launched, = self.aws.launch("ec2")
+        self.aws.fail('DescribeInstances')
+        summary = self.run_queue(launched)
+        self.assertEqual(summary["errors"], 1)
+        self.assertEqual(self.aws.calls['ReceiveMessage'], 3)
+        self.assertEqual(self.aws.messages, [])
+        self.assertTrue(self.alarms_for(launched))
+
+class ThresholdTest(unittest.TestCase):
+    def test_units(self):
+        self.assertEqual(aws_manage_alarms.compile_threshold('300 mb', 'test'), 300 * 1024 * 1024)
+        self.assertEqual(aws_manage_alarms.compile_threshold('5GB', 'test'), 5 * 1024 ** 3)
+
+    def test_bad_units(self):
+        for threshold in [ '5xb', '300 parsecs' ]:
+            self.assertRaises(ValueError, aws_manage_alarms.compile_threshold, threshold, 'test')
+
+if __name__ == '__main__':
+    unittest.main()